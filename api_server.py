@@ -0,0 +1,199 @@
+import json
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import catalog_db
+from catalog_db import (
+    PAGE_SIZE, TagFilter, writer, start_backfills,
+    count_hits, search_page, random_row, fetch_rows, fetch_latest_presets, fetch_detail, build_prompt,
+)
+from db_migrate import apply_migrations
+
+# 画面なしでカタログを引くためのローカルJSON API（スクリプトやWebUI拡張から使う）。
+#   python api_server.py --port 8765
+#
+#   GET /search?q=&kind=&tag=&any_tag=&not_tag=&sort=mtime|title&order=DESC|ASC&limit=&after=
+#       kind/tag/any_tag/not_tag は繰り返し可。after は前のレスポンスの "next" をそのまま渡す
+#   GET /lora/<id>            行と最新プリセット（?detail=1 で info/metadata も）
+#   GET /random?q=&kind=...   検索条件から1件
+#   GET /prompt?id=<id>&weight=<w>   id/weight は繰り返し可（weight省略時 0.8）
+#
+# 接続は catalog_db のプールと検索キャッシュをそのまま使う。
+
+DEFAULT_PORT = 8765
+MAX_LIMIT = 200
+DEFAULT_WEIGHT = 0.8
+
+ROW_KEYS = ("id", "name", "trigger", "preview_thumb", "path", "kind", "title")
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2**63, 2**63 - 1  # これを超える値はsqlite3がOverflowErrorにする
+
+class BadRequest(ValueError):
+    pass
+
+def row_dict(row) -> dict:
+    return dict(zip(ROW_KEYS, row))
+
+def one(qs: dict, key: str, default: str = "") -> str:
+    return qs.get(key, [default])[-1]
+
+def search_args(qs: dict) -> dict:
+    return {
+        "q": one(qs, "q").strip(),
+        "selected_kinds": qs.get("kind", []),
+        "tags": TagFilter(tuple(qs.get("tag", [])), tuple(qs.get("any_tag", [])), tuple(qs.get("not_tag", []))),
+    }
+
+def check_int(value: int, name: str) -> int:
+    if not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+        raise BadRequest(f"{name} is out of range")
+    return value
+
+def parse_int(value: str, name: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer") from None
+    return check_int(n, name)
+
+def parse_cursor(value: str):
+    # "next" はJSONの [sortキー, id]。キャッシュキーに使うのでタプルに戻す
+    if not value:
+        return None
+    # sortキーは mtime(数値) か title(文字列) だけ。dict等はキャッシュキーにできないので弾く
+    try:
+        key, lora_id = json.loads(value)
+        if isinstance(key, bool) or not isinstance(key, (str, int, float)):
+            raise TypeError
+        if isinstance(key, int):
+            check_int(key, "after")
+        return (key, check_int(int(lora_id), "after"))
+    except (ValueError, TypeError, OverflowError):
+        raise BadRequest("after must be the 'next' value of a previous response") from None
+
+def handle_search(qs: dict) -> dict:
+    args = search_args(qs)
+    sort_col = "title" if one(qs, "sort") == "title" else "mtime"
+    sort_dir = "ASC" if one(qs, "order").upper() == "ASC" else "DESC"
+    limit = min(MAX_LIMIT, max(1, parse_int(one(qs, "limit", str(PAGE_SIZE)), "limit")))
+    rows, cursor = search_page(
+        args["q"], args["selected_kinds"], sort_col, sort_dir,
+        after=parse_cursor(one(qs, "after")), limit=limit, tags=args["tags"],
+    )
+    return {
+        "total": count_hits(**args),
+        "items": [row_dict(r) for r in rows],
+        "next": json.dumps(cursor, ensure_ascii=False) if cursor else None,
+    }
+
+def handle_lora(lora_id: int, qs: dict) -> dict | None:
+    rows = fetch_rows([lora_id])
+    if not rows:
+        return None
+    out = row_dict(rows[0])
+    body_id, body_prompt, clothes_id, clothes_prompt = fetch_latest_presets([lora_id]).get(lora_id, (None, None, None, None))
+    out["body"] = {"id": body_id, "prompt": body_prompt} if body_id is not None else None
+    out["clothes"] = {"id": clothes_id, "prompt": clothes_prompt} if clothes_id is not None else None
+    if one(qs, "detail") in ("1", "true"):
+        info_json, meta_json = fetch_detail(lora_id)
+        out["info"] = json.loads(info_json) if info_json else None
+        out["metadata"] = json.loads(meta_json) if meta_json else None
+    return out
+
+def handle_random(qs: dict) -> dict | None:
+    row = random_row(**search_args(qs))
+    return row_dict(row) if row else None
+
+def handle_prompt(qs: dict) -> dict:
+    ids = [parse_int(v, "id") for v in qs.get("id", [])]
+    if not ids:
+        raise BadRequest("id is required")
+    weights = qs.get("weight", [])
+    items = []
+    for i, lora_id in enumerate(ids):
+        try:
+            w = float(weights[i]) if i < len(weights) else DEFAULT_WEIGHT
+        except ValueError:
+            raise BadRequest("weight must be a number") from None
+        items.append((lora_id, w))
+    return {"prompt": build_prompt(items)}
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive で同じ接続を使い回せるように HTTP/1.1 で返す
+    protocol_version = "HTTP/1.1"
+    # ヘッダと本文を別々に書くので、Nagleを切らないと遅延ACK待ちで数十ms遅れる
+    disable_nagle_algorithm = True
+    quiet = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        qs = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        try:
+            if parts == ["search"]:
+                self.send_json(handle_search(qs))
+            elif len(parts) == 2 and parts[0] == "lora":
+                self.send_json_or_404(handle_lora(parse_int(parts[1], "id"), qs))
+            elif parts == ["random"]:
+                self.send_json_or_404(handle_random(qs))
+            elif parts == ["prompt"]:
+                self.send_json(handle_prompt(qs))
+            else:
+                self.send_json({"error": "not found"}, HTTPStatus.NOT_FOUND)
+        except BadRequest as e:
+            self.send_json({"error": str(e)}, HTTPStatus.BAD_REQUEST)
+        except Exception as e:
+            self.log_error("%s: %r", self.path, e)
+            self.send_json({"error": "internal error"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def send_json_or_404(self, obj):
+        if obj is None:
+            self.send_json({"error": "not found"}, HTTPStatus.NOT_FOUND)
+        else:
+            self.send_json(obj)
+
+    def send_json(self, obj, status: HTTPStatus = HTTPStatus.OK):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def log_error(self, format, *args):
+        # エラーは quiet でも出す
+        super().log_message(format, *args)
+
+def make_server(host: str = "127.0.0.1", port: int = DEFAULT_PORT, verbose: bool = False) -> ThreadingHTTPServer:
+    # スキーマだけ先に上げて、重いバックフィルは裏で流す（app.py と同じ）
+    with writer() as conn:
+        apply_migrations(conn)
+    start_backfills()
+
+    Handler.quiet = not verbose
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="LoRAカタログのJSON API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=DEFAULT_PORT)
+    ap.add_argument("--verbose", action="store_true", help="リクエストごとにログを出す")
+    args = ap.parse_args()
+
+    server = make_server(args.host, args.port, args.verbose)
+    print(f"[api] http://{args.host}:{server.server_port}/ db={catalog_db.DB_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        catalog_db.stop_backfills()
+        catalog_db.pool().close()
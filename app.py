@@ -1,256 +1,20 @@
-import sqlite3
-from pathlib import Path
 import streamlit as st
-import random
 from db_migrate import apply_migrations
+from thumb_cache import thumb_bytes, prefetch
+from catalog_db import (
+    PAGE_SIZE, writer, start_backfills, backfill_status,
+    count_hits, search_page, random_row, fetch_kinds, fetch_tags, search_facets, fetch_latest_presets, fetch_detail,
+    TagFilter, update_body_prompt, update_clothes_prompt, update_title, recipe_generate,
+)
 
-LORA_ROOT = Path(r"E:\AIDirectory\EasyReforge\Model\Lora")  # 変える
-DB_PATH   = LORA_ROOT / "__lora_catalog.sqlite"
-
-PAGE_SIZE = 36
-
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("PRAGMA foreign_keys=ON")
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
-    return conn
-
-def build_fts_query(q: str) -> str | None:
-    q = (q or "").strip()
-    if not q:
-        return None
-    
-    terms = [t for t in q.split() if t]
-    if not terms:
-        return None
-    
-    def esc(term: str) -> str:
-        term = term.replace('"', '""')
-        return f'"{term}"'
-        
-    parts = [f'(name:{esc(t)} OR title:{esc(t)})' for t in terms]
-    return " AND ".join(parts)
-
-
-@st.cache_data(show_spinner=False)
-def search_ids(q: str, selected_kinds: list[str], max_hits: int, sort_col: str, sort_dir: str) -> list[int]:
-    fts_query = build_fts_query(q)
-    conn = get_db()
-    
-    try:
-        where = []
-        params = []
-        
-        if selected_kinds:
-            where.append("COALESCE(NULLIF(lora.kind, ''), 'Unsorted') IN ({})".format(
-                ",".join(["?"] * len(selected_kinds))
-            ))
-            params.extend(selected_kinds)
-        
-        join_fts = ""
-        if fts_query:
-            join_fts = "JOIN lora_fts ON lora_fts.rowid = lora.id"
-            where.append("lora_fts MATCH ?")
-            params.append(fts_query)
-        
-        sort_dir = "DESC" if sort_dir.upper() != "ASC" else "ASC"
-        if sort_col == "title":
-            order_expr = "COALESCE(NULLIF(lora.title, ''), lora.name) COLLATE NOCASE"
-        else:
-            sort_col = "mtime"
-            order_expr = "lora.mtime"
-        
-        sql = f"""
-            SELECT lora.id
-            FROM lora 
-            {join_fts}
-        """
-        
-        if where:
-            sql += "WHERE " + " AND ".join(where)
-        
-        sql += f" ORDER BY {order_expr} {sort_dir}, lora.id DESC LIMIT ?"
-        params.append(int(max_hits))
-        
-        rows = conn.execute(sql, params).fetchall()
-        return [r[0] for r in rows]
-    finally:
-        conn.close()
-
-def fetch_page(ids, page: int):
-    conn = get_db()
-    start = page * PAGE_SIZE
-    chunk = ids[start:start+PAGE_SIZE]
-    if not chunk:
-        return []
-    qmarks = ",".join(["?"] * len(chunk))
-    rows = conn.execute(f"""
-        SELECT id, name, trigger, preview_thumb, path, kind, title 
-        FROM lora
-        WHERE id IN ({qmarks})
-    """, chunk).fetchall()
-    conn.close()
-    # INは順序が崩れるのでids順に並べ直す
-    m = {r[0]: r for r in rows}
-    return [m[i] for i in chunk if i in m]
-
-def fetch_kinds():
-    conn = get_db()
-    try:
-        rows = conn.execute("""
-            SELECT DISTINCT COALESCE(NULLIF(kind, ''), 'Unsorted') AS k
-            FROM lora
-            ORDER BY k COLLATE NOCASE
-        """).fetchall()
-        return [r[0] for r in rows]
-    finally:
-        conn.close()
-
-def fetch_body(lora_id: int):
-    conn = get_db()
-    try:
-        rows = conn.execute("""
-            SELECT id, body_prompt
-            FROM lora_body_preset
-            WHERE lora_id = ?
-            ORDER BY id DESC
-        """,
-        (lora_id,)).fetchall()
-        
-        return [r for r in rows]
-    finally:
-        conn.close()
-
-def fetch_clothes(lora_id: int):
-    conn = get_db()
-    try:
-        rows = conn.execute("""
-            SELECT id, clothes_prompt
-            FROM lora_outfit_preset
-            WHERE lora_id = ?
-            ORDER BY id DESC
-        """,
-        (lora_id,)).fetchall()
-        
-        return [r for r in rows]
-    finally:
-        conn.close()
-
-def lora_tag(name: str, w: float):
-    # A1111の <lora:NAME:W>
-    safe = name.replace(":", "_")
-    return f"<lora:{safe}:{w:.2f}>"
-
-def recipe_generate(name, weights, body_prompt: str | None, clothes_prompt: str | None):
-    # selected: rows of (id,name,trigger,thumb,path,kind)
-#    tags = []
-#    triggers = []
-#    for r in selected:
-#        _id, name, trigger, *_ = r
-#        tags.append(lora_tag(name, weights.get(_id, 0.8)))
-#        if trigger:
-#            triggers.append(trigger)
-#    prompt = " ".join(tags)
-#    if triggers:
-#        prompt += "\n" + ", ".join([t for t in triggers if t.strip()])
-#    return prompt.strip()
-
-    parts = []
-    parts.append(lora_tag(name, weights.get(_id, 0.8)))
-    
-    if body_prompt:
-        parts.append("\n" + body_prompt)
-    if clothes_prompt:
-        parts.append("\n" + clothes_prompt)
-        
-    final_prompt = ", ".join(parts)
-    return final_prompt
-    
-
-def update_body_prompt(id: int | None, lora_id: int, body_prompt: str | None):
-
-    if body_prompt is None:
-        return
-    
-    conn = get_db()
-    try:
-        if id is not None:
-            conn.execute(
-                """
-                UPDATE lora_body_preset 
-                SET body_prompt = ? 
-                WHERE id = ? AND lora_id = ? AND body_prompt IS NOT ?
-                """, 
-                (body_prompt, id, lora_id, body_prompt)
-            )
-        else:
-            conn.execute(
-                """
-                INSERT INTO lora_body_preset (lora_id, body_prompt) 
-                VALUES(?, ?)
-                """, 
-                (lora_id, body_prompt))
-        
-        conn.commit()
-    finally:
-        conn.close()
-
-def update_clothes_prompt(id: int | None, lora_id:int, clothes_prompt: str | None):
-
-    if clothes_prompt is None:
-        return
-        
-    conn = get_db()
-    try:
-        if id is not None:
-            conn.execute(
-                """
-                UPDATE lora_outfit_preset 
-                SET clothes_prompt = ? 
-                WHERE id = ? AND lora_id = ? AND clothes_prompt IS NOT ?
-                """, 
-                (clothes_prompt, id, lora_id, clothes_prompt)
-            )
-        else:
-            conn.execute(
-                """
-                INSERT INTO lora_outfit_preset (lora_id, clothes_prompt) 
-                VALUES(?, ?)
-                """, 
-                (lora_id, clothes_prompt))
-        
-        conn.commit()
-    finally:
-        conn.close()
-
-def update_title(lora_id: int, title: str):
-    conn = get_db()
-    try:
-        conn.execute("BEGIN")        
-        
-        if title is not None:
-            conn.execute("UPDATE lora SET title=? WHERE id=?", (title, lora_id))
-            conn.execute("""
-                UPDATE lora_fts
-                SET title=?
-                WHERE rowid=?
-            """, (title, lora_id))
-            conn.commit()
-    except:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
-    
 def startup_migrate():
     if "migrated" not in st.session_state:
-        conn = get_db()
-        try:
+        # マイグレーションも書き込み用の接続で直列化する
+        with writer() as conn:
             apply_migrations(conn)
-        finally:
-            conn.close()
         st.session_state.migrated = True
+        # 重いデータ移行は裏で流し、画面はその間も使えるようにする（プロセスで1回だけ）
+        start_backfills()
 
 startup_migrate()
 
@@ -258,25 +22,45 @@ st.set_page_config(layout="wide", page_title="LoRA Library (Light)")
 
 st.title("LoRA Library (Light)")
 
+pending = backfill_status()
+if pending:
+    st.info("検索インデックスを作成中です（" + ", ".join(name for name, _ in pending) + "）。終わるまで検索結果が欠けることがあります")
+
 all_kinds = fetch_kinds()
 
 st.session_state.setdefault("picked", {})
 st.session_state.setdefault("w", {})
 st.session_state.setdefault("single_pick", True)
 st.session_state.setdefault("page", 0)
+st.session_state.setdefault("cursors", [None])
 
-max_hits = st.slider("最大ヒット数（増やすと重くなる）", 200, 5000, 1500, 100)
+def tag_filter_state() -> TagFilter:
+    return TagFilter(
+        tuple(st.session_state.get("tag_require", [])),
+        tuple(st.session_state.get("tag_either", [])),
+        tuple(st.session_state.get("tag_exclude", [])),
+    )
 
 c_kinds, c_q, c_sort, c_order = st.columns([2, 2, 2, 2])
 
+# 種別の件数は検索ワードで変わるので、ウィジェットより先にsession_stateの値で数えておく
+facets = search_facets(
+    st.session_state.get("q", "").strip(),
+    st.session_state.get("kinds", []),
+    tag_filter_state(),
+)
+kind_counts = facets["kinds"]
+
 with c_kinds:
     selected_kinds = st.multiselect(
         "LoRAの種別",
         options=all_kinds,
+        format_func=lambda k: f"{k} ({kind_counts.get(k, 0)})",
+        key="kinds",
     )
 
 with c_q:
-    q = st.text_input("検索ワード", value="").strip()
+    q = st.text_input("検索ワード", value="", key="q").strip()
 
 with c_sort:
     sort_col = st.selectbox(
@@ -295,16 +79,29 @@ with c_order:
         key="sort_dir",
     )
 
-st.markdown('<p style="color:red;">※ 検索ワードはスペース区切りでAND。2文字以下はヒットしません</p>', unsafe_allow_html=True)
+all_tags = fetch_tags()
+c_t_req, c_t_any, c_t_not = st.columns(3)
+with c_t_req:
+    st.multiselect("タグ（すべて含む）", options=all_tags, key="tag_require")
+with c_t_any:
+    st.multiselect("タグ（どれかを含む）", options=all_tags, key="tag_either")
+with c_t_not:
+    st.multiselect("タグ（除外）", options=all_tags, key="tag_exclude")
+tags = tag_filter_state()
 
-query_sig = (q, tuple(selected_kinds), sort_col, sort_dir)
+st.caption("※ 検索ワードはスペース区切りでAND。名前・タイトルの部分一致（1〜2文字の語も可）")
+if facets["tags"]:
+    st.caption("多いタグ: " + "  ".join(f"{t} ({n})" for t, n in facets["tags"]))
+
+query_sig = (q, tuple(selected_kinds), tags, sort_col, sort_dir)
 
 if st.session_state.get("query_sig") != query_sig:
     st.session_state["query_sig"] = query_sig
     st.session_state["page"] = 0
+    st.session_state["cursors"] = [None]
 
-# ヒットID取得（FTS）
-ids = search_ids(q, selected_kinds, max_hits, sort_col, sort_dir)
+# 件数だけ数えて、表示するページ分だけ読む（キーセットページング）
+total = count_hits(q, selected_kinds, tags)
 
 colA, colB = st.columns([3, 1], gap="large")
 
@@ -318,30 +115,45 @@ with colB:
     picked_area = st.container()
 
 with colA:
-    st.subheader(f"Results: {len(ids)}")
-    pages = max(1, (len(ids) + PAGE_SIZE - 1) // PAGE_SIZE)
-    max_page = max(0, pages - 1)
+    st.subheader(f"Results: {total}")
+    pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
     
-    if st.session_state["page"] > max_page:
-        st.session_state["page"] = 0
+    # cursors[i] は i ページ目の開始位置（前ページ最後の (sortキー, id)）
+    cursors = st.session_state["cursors"]
+    page = min(st.session_state["page"], len(cursors) - 1)
+    rows, next_cursor = search_page(q, selected_kinds, sort_col, sort_dir, after=cursors[page], tags=tags)
     
-    # valueを渡さなくてもkeyを渡してるから、session_stateで管理できる
-    page = st.number_input(
-        "page", 
-        min_value=0, 
-        max_value=max_page, 
-        step=1,
-        key="page",
-    )
-    rows = fetch_page(ids, int(page))
+    c_prev, c_page, c_next = st.columns([1, 2, 1])
+    with c_prev:
+        if st.button("◀ 前へ", disabled=page == 0):
+            st.session_state["page"] = page - 1
+            st.rerun()
+    with c_page:
+        st.caption(f"page {page + 1} / {pages}")
+    with c_next:
+        if st.button("次へ ▶", disabled=next_cursor is None):
+            del cursors[page + 1:]
+            cursors.append(next_cursor)
+            st.session_state["page"] = page + 1
+            st.rerun()
+
+    # 前後のページのサムネイルを裏で読んでおく（クエリごとワーカーで実行）
+    adjacent = ([cursors[page - 1]] if page > 0 else []) + ([next_cursor] if next_cursor else [])
+    def adjacent_thumbs(adjacent=adjacent, args=(q, list(selected_kinds), sort_col, sort_dir), tags=tags):
+        for cur in adjacent:
+            for r in search_page(*args, after=cur, tags=tags)[0]:
+                yield r[3]
+    if adjacent:
+        prefetch(adjacent_thumbs)
 
     # 6列グリッド
     cols = st.columns(6, gap="small")
     for i, r in enumerate(rows):
         _id, name, trigger, thumb, path,  k, title = r
         with cols[i % 6]:
-            if thumb and Path(thumb).exists():
-                st.image(thumb, width="stretch")
+            img = thumb_bytes(thumb)
+            if img:
+                st.image(img, width="stretch")
             display = title or name
             st.caption(f"{display}\n[{k or '-'}]")
             if st.button("Pick", key=f"pick_{_id}"):
@@ -361,48 +173,36 @@ with picked_area:
         st.session_state.w = {}
         st.rerun()
 
-    if st.button("ランダムで追加（今の検索結果から1つ）") and ids:
-        rid = random.choice(ids)
-        # 取得して追加（簡易）
-        r = fetch_page([rid], 0)
+    if st.button("ランダムで追加（今の検索結果から1つ）") and total:
+        r = random_row(q, selected_kinds, tags)
         if r:
+            rid = r[0]
             if single_pick:
-                st.session_state.picked = {rid: r[0]}
+                st.session_state.picked = {rid: r}
                 st.session_state.w = {rid: 0.8}
             else:
-                st.session_state.picked[rid] = r[0]
+                st.session_state.picked[rid] = r
                 st.session_state.w.setdefault(rid, 0.8)
             st.rerun()
 
     st.caption(f"選択数: {len(st.session_state.picked)}")
 
+    # 最新プリセットはPickした分をまとめて1回で読む
+    presets = fetch_latest_presets(st.session_state.picked.keys())
+    
     # 重み調整
     for _id, row in list(st.session_state.picked.items()):
         name = row[1]
         thumb = row[3]
         title = row[6]
         
-        body_list = fetch_body(_id)
-        clothes_list = fetch_clothes(_id)
-        
-        if body_list is not None and len(body_list) > 0:
-            body_id = body_list[0][0]
-            body_prompt = body_list[0][1]
-        else:
-            body_id = None
-            body_prompt = None
-        
-        if clothes_list is not None and len(clothes_list) > 0:
-            clothes_id = clothes_list[0][0]
-            clothes_prompt = clothes_list[0][1]
-        else:
-            clothes_id = None
-            clothes_prompt = None
+        body_id, body_prompt, clothes_id, clothes_prompt = presets.get(_id, (None, None, None, None))
             
         display = title or name
         
-        if thumb and Path(thumb).exists():
-                st.image(thumb, width="stretch")
+        img = thumb_bytes(thumb)
+        if img:
+                st.image(img, width="stretch")
                 
         st.session_state.w[_id] = st.slider(name, 0.1, 1.5, float(st.session_state.w.get(_id, 0.8)), 0.05)
         
@@ -410,6 +210,16 @@ with picked_area:
         new_body_prompt = st.text_input(f"body", value=body_prompt, key=f"body_{_id}")
         new_clothes_prompt = st.text_input(f"clothes", value=clothes_prompt, key=f"clothes_{_id}")
         
+        # info/metadata は開いたときだけ読んで展開する
+        if st.toggle("詳細", key=f"detail_{_id}"):
+            info_json, meta_json = fetch_detail(_id)
+            if info_json:
+                st.json(info_json, expanded=False)
+            if meta_json:
+                st.json(meta_json, expanded=False)
+            if not (info_json or meta_json):
+                st.caption("info / metadata なし")
+        
         if st.button("Save Data", key=f"save_data_{_id}"):
             update_title(_id, new_title)
             
@@ -434,5 +244,5 @@ with picked_area:
         st.divider()
         st.subheader("Prompt")
 #        out = recipe_generate(list(st.session_state.picked.values()),  st.session_state.w, body, clothes)
-        out = recipe_generate(name, st.session_state.w, body_prompt, clothes_prompt)
+        out = recipe_generate(name, st.session_state.w.get(_id, 0.8), body_prompt, clothes_prompt)
         st.code(out, language="text")
@@ -0,0 +1,345 @@
+import os, io, sys, json, time, random, shutil, argparse, tempfile, importlib, statistics, threading
+import http.client
+from urllib.parse import quote
+from contextlib import redirect_stdout
+from pathlib import Path
+import synth_library
+
+# スキャナと検索まわりのベンチマーク。
+#   python bench.py --count 10000            # 合成ライブラリを作って全部測る
+#   python bench.py --root D:\bench --json bench_output.json
+#   python bench.py --api                    # api_server の応答の中身も http.client で確かめてから測る
+# 合成ライブラリは --root に残るので2回目以降は生成を飛ばす（--regen で作り直し）
+
+SEARCH_CASES = {
+    # name: (q, kinds, sort_col, sort_dir)
+    "all_mtime":      ("", [], "mtime", "DESC"),
+    "all_title_asc":  ("", [], "title", "ASC"),
+    "term":           ("Miku", [], "mtime", "DESC"),
+    "two_terms":      ("Miku 123", [], "mtime", "DESC"),
+    "short_term":     ("桜", [], "mtime", "DESC"),
+    "short_two":      ("Mi", [], "title", "ASC"),
+    "short_long":     ("雪 Ink", [], "mtime", "DESC"),
+    "kind":           ("", ["char"], "mtime", "DESC"),
+    "kind_term":      ("Cyber", ["style", "char"], "title", "ASC"),
+    "no_hit":         ("zzzzzz", [], "mtime", "DESC"),
+}
+
+def ms_stats(samples: list[float]) -> dict:
+    xs = sorted(s * 1000 for s in samples)
+    return {
+        "median_ms": statistics.median(xs),
+        "p95_ms": xs[min(len(xs) - 1, int(round(0.95 * (len(xs) - 1))))],
+        "min_ms": xs[0],
+        "n": len(xs),
+    }
+
+def timed(fn, rounds: int):
+    samples = []
+    result = None
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - t0)
+    return ms_stats(samples), result
+
+def quiet_scan(scan_loras, **kw) -> float:
+    t0 = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        scan_loras.main(**kw)
+    return time.perf_counter() - t0
+
+def mutate(root: Path, ratio: float, gen_args, seed: int, backup: Path) -> dict:
+    # 一部だけ変える: 既存ファイルの書き換え・追加・削除。seedが同じなら毎回同じ変更になる。
+    # 消すファイルは backup に退避し、restore() で元のライブラリに戻せるように記録を返す
+    rng = random.Random(seed)
+    files = sorted(root.rglob("*.safetensors"))
+    n = max(1, int(len(files) * ratio))
+    touched = rng.sample(files, min(n, len(files)))
+    undo = {
+        "changes": {"modified": n // 2, "deleted": n - n // 2, "added": n // 2},
+        "modified": [], "deleted": [], "added": [],
+    }
+    for f in touched[: n // 2]:
+        undo["modified"].append((f, f.stat().st_size))
+        with f.open("ab") as fh:
+            fh.write(rng.randbytes(1024))
+    for f in touched[n // 2:]:
+        for side in f.parent.glob(f.stem + ".*"):
+            dest = backup / side.relative_to(root)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(side, dest)
+            undo["deleted"].append((dest, side))
+    start = 10_000_000 + seed
+    for i in range(n // 2):
+        f = synth_library.write_entry(root, rng, start + i, gen_args)
+        undo["added"] += f.parent.glob(f.stem + ".*")
+    return undo
+
+def restore(undo: dict):
+    # mutate() の変更を戻す（書き換えは追記しただけなので元の長さに切り詰める）
+    for f, size in undo["modified"]:
+        with f.open("r+b") as fh:
+            fh.truncate(size)
+    for f in undo["added"]:
+        f.unlink(missing_ok=True)
+    for src, dest in undo["deleted"]:
+        shutil.move(src, dest)
+
+def run(args) -> dict:
+    root = args.root
+    gen_args = synth_library.build_parser().parse_args([str(root), "--count", str(args.count)])
+    gen_args.preview_size = args.preview_size
+    gen_args.payload_kb = args.payload_kb
+    
+    if args.regen and root.exists():
+        shutil.rmtree(root)
+    if not root.exists():
+        t0 = time.perf_counter()
+        synth_library.generate(root, args.count, gen_args)
+        print(f"generated {args.count} entries in {time.perf_counter() - t0:.1f}s -> {root}")
+    
+    # 各モジュールは import 時に LORA_ROOT を読むので、ここで差し替えてから読み込む
+    os.environ["LORA_ROOT"] = str(root)
+    scan_loras = importlib.import_module("scan_loras")
+    catalog_db = importlib.import_module("catalog_db")
+    
+    for p in (scan_loras.THUMB_DIR,):
+        shutil.rmtree(p, ignore_errors=True)
+    for p in root.glob(scan_loras.DB_PATH.name + "*"):
+        p.unlink()
+    
+    # 前回の実行が途中で落ちていると数が合わないことがあるので、実際の件数を記録する
+    count = sum(1 for _ in root.rglob("*.safetensors"))
+    if count != args.count:
+        print(f"warning: {root} has {count} entries (--count {args.count}); use --regen to rebuild")
+    results = {"count": count, "root": str(root), "scan": {}, "search": {}, "search_cached": {}, "count_hits": {}, "facets": {}, "page": {}}
+    scan_kw = {"hash_workers": args.hash_workers}
+    
+    results["scan"]["cold_s"] = quiet_scan(scan_loras, **scan_kw)
+    results["scan"]["noop_s"] = quiet_scan(scan_loras, **scan_kw)
+    # 部分変更はライブラリを直接いじるので、測り終えたら元に戻す（次回も同じライブラリで比べられるように）
+    backup = Path(tempfile.mkdtemp(prefix=root.name + ".undo.", dir=root.parent))
+    undo = mutate(root, args.change_ratio, gen_args, gen_args.seed, backup)
+    try:
+        results["scan"]["partial_s"] = quiet_scan(scan_loras, **scan_kw)
+        results["scan"]["partial_changes"] = undo["changes"]
+        results["scan"]["noop_after_partial_s"] = quiet_scan(scan_loras, **scan_kw)
+    finally:
+        restore(undo)
+        shutil.rmtree(backup, ignore_errors=True)
+    
+    # search は1ページ目、count_hits は件数クエリ。どちらも検索キャッシュを空にして測る。
+    # search_cached はキャッシュに載った後（id列から主キーで行を読むだけ）
+    cache = catalog_db.search_cache()
+    def uncached(fn):
+        def call():
+            cache.clear()
+            return fn()
+        return call
+    for name, (q, kinds, sort_col, sort_dir) in SEARCH_CASES.items():
+        page = lambda: catalog_db.search_page(q, kinds, sort_col, sort_dir)
+        st, (rows, _) = timed(uncached(page), args.rounds)
+        st["hits"] = len(rows)
+        results["search"][name] = st
+        st, (rows, _) = timed(page, args.rounds)
+        st["hits"] = len(rows)
+        results["search_cached"][name] = st
+        st, total = timed(uncached(lambda: catalog_db.count_hits(q, kinds)), args.rounds)
+        st["hits"] = total
+        results["count_hits"][name] = st
+        st, facets = timed(uncached(lambda: catalog_db.search_facets(q, kinds)), args.rounds)
+        st["hits"] = len(facets["tags"])
+        results["facets"][name] = st
+    results["search_cache"] = cache.stats()
+    
+    # 深いページも1ページ目と同じコストになっているか。カーソルを辿って位置を取る
+    for sort_col, sort_dir in (("mtime", "DESC"), ("title", "ASC")):
+        cursors = [None]
+        while True:
+            _, cur = catalog_db.search_page("", [], sort_col, sort_dir, after=cursors[-1])
+            if cur is None:
+                break
+            cursors.append(cur)
+        last = len(cursors) - 1
+        for name, page in (("first", 0), ("middle", last // 2), ("last", last)):
+            st, (rows, _) = timed(uncached(lambda: catalog_db.search_page("", [], sort_col, sort_dir, after=cursors[page])), args.rounds)
+            st["hits"] = len(rows)
+            results["page"][f"{sort_col}_{name}"] = st
+    
+    results["plan_problems"] = catalog_db.check_query_plans()
+    if args.api:
+        results["api_problems"] = check_api(catalog_db)
+        results["api"] = bench_api(catalog_db, args.rounds)
+    return results
+
+def start_api():
+    # api_server を同じプロセスの別スレッドで立てる。戻り値: (server, keep-aliveの接続)
+    api_server = importlib.import_module("api_server")
+    with redirect_stdout(io.StringIO()):
+        server = api_server.make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, http.client.HTTPConnection("127.0.0.1", server.server_port)
+
+def check_api(catalog_db) -> list[str]:
+    # 各エンドポイントの中身を catalog_db の結果と突き合わせる。問題の説明を返す（空なら OK）
+    server, conn = start_api()
+    row_keys = set(importlib.import_module("api_server").ROW_KEYS)
+    problems = []
+    
+    def get(path):
+        conn.request("GET", path)
+        res = conn.getresponse()
+        return res.status, json.loads(res.read())
+    
+    def expect(name, ok, detail=""):
+        if not ok:
+            problems.append(f"{name}: {detail}")
+    
+    try:
+        # 検索: 件数と1ページ目、nextを辿った全ページが catalog_db の並びと一致するか
+        for path, q, kinds, sort_col, sort_dir in (
+            ("/search?sort=title&order=ASC&limit=50", "", [], "title", "ASC"),
+            ("/search?kind=char&kind=style&limit=50", "", ["char", "style"], "mtime", "DESC"),
+            ("/search?q=" + quote("Mi") + "&limit=50", "Mi", [], "mtime", "DESC"),
+        ):
+            status, body = get(path)
+            expect(path, status == 200, f"status {status}")
+            if status != 200:
+                continue
+            expect(path, body["total"] == catalog_db.count_hits(q, kinds), f"total {body['total']}")
+            expect(path, body["items"] and all(set(it) == row_keys for it in body["items"]), "no items or wrong keys")
+            ids = [it["id"] for it in body["items"]]
+            while body["next"]:
+                status, body = get(path + "&after=" + quote(body["next"]))
+                expect(path, status == 200, f"next page status {status}")
+                if status != 200:
+                    break
+                ids += [it["id"] for it in body["items"]]
+            want, after = [], None
+            while True:
+                rows, after = catalog_db.search_page_uncached(q, kinds, sort_col, sort_dir, after=after, limit=50)
+                want += [r[0] for r in rows]
+                if after is None:
+                    break
+            expect(path, ids == want, f"paged ids differ ({len(ids)} vs {len(want)})")
+        
+        # 1件: 行・プリセット・詳細
+        row = catalog_db.search_page_uncached("", [], "mtime", "DESC", limit=1)[0][0]
+        status, body = get(f"/lora/{row[0]}?detail=1")
+        expect("/lora", status == 200 and body["id"] == row[0] and body["path"] == row[4], f"{status} {body}")
+        expect("/lora", status == 200 and {"body", "clothes", "info", "metadata"} <= set(body), "missing keys")
+        
+        status, body = get("/random?kind=char")
+        expect("/random", status == 200 and body["kind"] == "char", f"{status} {body}")
+        status, body = get(f"/prompt?id={row[0]}&weight=0.7")
+        want = catalog_db.build_prompt([(row[0], 0.7)])
+        expect("/prompt", status == 200 and body["prompt"] == want, f"{status} {body}")
+        
+        # エラー: 無いものは404、壊れた入力は400（500にならないこと）
+        for path, want_status in (
+            ("/lora/999999999", 404),
+            ("/random?q=zzzzzzzz", 404),
+            ("/nowhere", 404),
+            ("/lora/abc", 400),
+            ("/lora/99999999999999999999", 400),
+            ("/prompt", 400),
+            ("/prompt?id=99999999999999999999", 400),
+            ("/prompt?id=1&weight=abc", 400),
+            ("/search?limit=abc", 400),
+            ("/search?after=" + quote("[{},1]"), 400),
+            ("/search?after=" + quote("[1,99999999999999999999]"), 400),
+            ("/search?after=" + quote("[99999999999999999999,1]"), 400),
+            ("/search?after=" + quote("[1,Infinity]"), 400),
+            ("/search?after=garbage", 400),
+        ):
+            status, body = get(path)
+            expect(path, status == want_status and "error" in body, f"status {status}, want {want_status}")
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+    return problems
+
+def bench_api(catalog_db, rounds: int) -> dict:
+    # keep-aliveの1接続で叩く（キャッシュ込みの実測）
+    server, conn = start_api()
+    
+    def get(path):
+        def call():
+            conn.request("GET", path)
+            res = conn.getresponse()
+            body = res.read()
+            if res.status != 200:
+                raise RuntimeError(f"{path}: {res.status} {body[:200]!r}")
+            return json.loads(body)
+        return call
+    
+    first = get("/search")()
+    lora_id = first["items"][0]["id"]
+    deep = get("/search?sort=title&order=ASC&after=" + quote(first["next"] or ""))() if first["next"] else first
+    paths = {
+        "search": "/search?q=" + quote("Miku"),
+        "search_title": "/search?sort=title&order=ASC&kind=char",
+        "search_next": "/search?sort=title&order=ASC&after=" + quote(deep["next"] or "") if deep["next"] else "/search",
+        "lora": f"/lora/{lora_id}",
+        "lora_detail": f"/lora/{lora_id}?detail=1",
+        "random": "/random?kind=char",
+        "prompt": f"/prompt?id={lora_id}&weight=0.7",
+    }
+    out = {}
+    for name, path in paths.items():
+        st, _ = timed(get(path), max(rounds, 50))
+        out[name] = st
+    conn.close()
+    server.shutdown()
+    server.server_close()
+    return out
+
+def print_results(res: dict):
+    print(f"\n== scan ({res['count']} entries) ==")
+    for k, v in res["scan"].items():
+        print(f"  {k:<22} {v:.3f}s" if isinstance(v, float) else f"  {k:<22} {v}")
+    for section in ("search", "search_cached", "count_hits", "facets", "page"):
+        print(f"== {section} ==")
+        print(f"  {'case':<16}{'median(ms)':>12}{'p95(ms)':>10}{'min(ms)':>10}{'hits':>8}")
+        for name, st in res[section].items():
+            print(f"  {name:<16}{st['median_ms']:>12.2f}{st['p95_ms']:>10.2f}{st['min_ms']:>10.2f}{st.get('hits', ''):>8}")
+    if "api" in res:
+        print("== api (keep-alive, http.client) ==")
+        print(f"  {'case':<16}{'median(ms)':>12}{'p95(ms)':>10}{'min(ms)':>10}")
+        for name, st in res["api"].items():
+            print(f"  {name:<16}{st['median_ms']:>12.2f}{st['p95_ms']:>10.2f}{st['min_ms']:>10.2f}")
+    print("== query plans ==")
+    for p in res["plan_problems"]:
+        print(f"  NG {p}")
+    if not res["plan_problems"]:
+        print("  OK (no temp b-tree sorts)")
+    if "api_problems" in res:
+        print("== api checks ==")
+        for p in res["api_problems"]:
+            print(f"  NG {p}")
+        if not res["api_problems"]:
+            print("  OK")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="scan_loras / 検索のベンチマーク")
+    ap.add_argument("--root", type=Path, default=Path(tempfile.gettempdir()) / "lora_bench")
+    ap.add_argument("--count", type=int, default=2000)
+    ap.add_argument("--regen", action="store_true", help="合成ライブラリを作り直す")
+    ap.add_argument("--preview-size", type=int, default=512)
+    ap.add_argument("--payload-kb", type=int, default=256)
+    ap.add_argument("--change-ratio", type=float, default=0.05, help="部分変更で触るファイルの割合")
+    ap.add_argument("--hash-workers", type=int, default=8)
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--json", metavar="PATH", help="結果をJSONで書き出す")
+    ap.add_argument("--api", action="store_true", help="api_server のレイテンシも測る")
+    args = ap.parse_args()
+    
+    res = run(args)
+    print_results(res)
+    if args.json:
+        Path(args.json).write_text(json.dumps(res, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"-> {args.json}")
+    if res["plan_problems"] or res.get("api_problems"):
+        sys.exit(1)
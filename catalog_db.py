@@ -0,0 +1,631 @@
+import os
+import sys
+import queue
+import random
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+from db_migrate import refresh_fts, run_backfill_chunk, pending_backfills, unpack_json, GRAM_MAX
+
+# LORA_ROOT は環境変数で差し替えられる（ベンチや別ライブラリ用）
+LORA_ROOT = Path(os.environ.get("LORA_ROOT", r"E:\AIDirectory\EasyReforge\Model\Lora"))  # 変える
+DB_PATH   = LORA_ROOT / "__lora_catalog.sqlite"
+
+PAGE_SIZE = 36
+
+READ_POOL_SIZE = 4                 # 同時に使う読み取り接続の上限
+MMAP_SIZE      = 256 * 1024 * 1024 # DBファイルをmmapで読む範囲
+CACHE_SIZE_KB  = 64 * 1024         # 接続ごとのページキャッシュ
+STMT_CACHE     = 256               # 接続ごとのprepared statementキャッシュ
+
+SEARCH_CACHE_ENTRIES = 512             # 検索キャッシュの件数上限
+SEARCH_CACHE_BYTES   = 8 * 1024 * 1024 # 検索キャッシュのおおよそのバイト上限
+FACET_TAGS           = 20              # 検索結果に多いタグを何件まで数えるか
+
+def open_tuned(read_only: bool):
+    # PRAGMAは接続を作るときの一度だけ。SQL文字列ごとのprepareはcached_statementsが使い回す
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STMT_CACHE)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+class ConnectionPool:
+    # プロセス内で共有する接続。Streamlitは再実行してもモジュールは読み直さないので
+    # 接続はプロセスが生きている間ずっと使い回される
+    def __init__(self, size: int = READ_POOL_SIZE):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._writer = None
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def reader(self):
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = open_tuned(read_only=True)
+            except Exception:
+                self._slots.release()
+                raise
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+            self._slots.release()
+
+    @contextmanager
+    def writer(self):
+        # 書き込みは専用の1本だけ。ロックで直列化して、抜けるときにcommitする
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = open_tuned(read_only=False)
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+def reader():
+    return pool().reader()
+
+def writer():
+    return pool().writer()
+
+_backfill_checked = False
+_backfill_thread = None
+backfill_stop = threading.Event()
+
+def start_backfills():
+    # 残っているバックフィルを裏のスレッドで流す。見るのはプロセスで1回だけで、
+    # 残りが無ければスレッドも立てない（Streamlitの再実行ごとには何もしない）
+    global _backfill_checked, _backfill_thread
+    with _pool_lock:
+        if _backfill_checked:
+            return
+        _backfill_checked = True
+    pending = backfill_status()
+    if pending:
+        _backfill_thread = threading.Thread(target=backfill_worker, args=(pending,), name="backfill", daemon=True)
+        _backfill_thread.start()
+
+def backfill_worker(pending):
+    # 接続はプールの書き込み用をチャンクごとに借りる。UIの保存はチャンクの間に割り込める
+    for name, _ in pending:
+        while not backfill_stop.is_set():
+            with writer() as conn:
+                _, finished = run_backfill_chunk(conn, name)
+            if finished:
+                break
+
+def stop_backfills(timeout: float | None = None):
+    # 終了時用。今のチャンクをcommitしたところで止める（続きは次回の起動で再開）
+    backfill_stop.set()
+    if _backfill_thread is not None:
+        _backfill_thread.join(timeout)
+
+def backfill_status() -> list[tuple[str, int]]:
+    # 終わっていないバックフィル [(名前, 最後に処理したid)]
+    with reader() as conn:
+        return pending_backfills(conn)
+
+class SearchCache:
+    # 検索結果（件数・ページのid列）のキャッシュ。
+    # 世代は専用接続の PRAGMA data_version。他の接続（writer()・scan_loras.py）がcommitすると
+    # 値が変わるので、そのときだけ全部捨てる。id列は array('q') で持つ
+    def __init__(self, max_entries: int = SEARCH_CACHE_ENTRIES, max_bytes: int = SEARCH_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()   # key -> (value, nbytes)
+        self._size = 0
+        self._gen = None
+        self._lock = threading.Lock()
+        self._ver_conn = None
+        self._ver_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self) -> int:
+        with self._ver_lock:
+            if self._ver_conn is None:
+                self._ver_conn = open_tuned(read_only=True)
+            return self._ver_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def get(self, key):
+        # (世代, 値 or None)。世代は put に渡す
+        gen = self.generation()
+        with self._lock:
+            if gen != self._gen:
+                self._data.clear()
+                self._size = 0
+                self._gen = gen
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return gen, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return gen, item[0]
+
+    def put(self, key, value, gen: int, nbytes: int):
+        with self._lock:
+            # 計算中に書き込みがあった結果は入れない
+            if gen != self._gen or key in self._data or nbytes > self.max_bytes:
+                return
+            self._data[key] = (value, nbytes)
+            self._size += nbytes
+            while len(self._data) > self.max_entries or self._size > self.max_bytes:
+                _, (_, n) = self._data.popitem(last=False)
+                self._size -= n
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._size, "generation": self._gen,
+                    "hits": self.hits, "misses": self.misses}
+
+_search_cache = None
+
+def search_cache() -> SearchCache:
+    global _search_cache
+    if _search_cache is None:
+        with _pool_lock:
+            if _search_cache is None:
+                _search_cache = SearchCache()
+    return _search_cache
+
+def key_bytes(key) -> int:
+    # おおよそでいい。TagFilterのようなタプルは中身まで数える
+    return sum(key_bytes(k) if isinstance(k, tuple) else sys.getsizeof(k) for k in key) + sys.getsizeof(key)
+
+def build_fts_query(q: str) -> tuple[str | None, list[str]]:
+    # (FTSのクエリ, 短い語のリスト)。trigramは3文字未満を引けないので
+    # 1〜2文字の語は lora_gram 側で引く。どちらもスペース区切りのAND
+    q = (q or "").strip()
+    if not q:
+        return None, []
+    
+    terms = [t for t in q.split() if t]
+    short_terms = [t for t in terms if len(t) <= GRAM_MAX]
+    long_terms = [t for t in terms if len(t) > GRAM_MAX]
+    
+    def esc(term: str) -> str:
+        term = term.replace('"', '""')
+        return f'"{term}"'
+        
+    parts = [f'(name:{esc(t)} OR title:{esc(t)})' for t in long_terms]
+    return (" AND ".join(parts) or None), short_terms
+
+ROW_COLS = "lora.id, lora.name, lora.trigger, lora.preview_thumb, lora.path, lora.kind, lora.title"
+
+class TagFilter(NamedTuple):
+    # タグ名での絞り込み。require は全部、either はどれか、exclude はどれも付いていないもの
+    require: tuple = ()
+    either: tuple = ()
+    exclude: tuple = ()
+
+NO_TAGS = TagFilter()
+
+# lora_tag(tag_id, lora_id) のインデックスで、タグ1つ分のlora_idを範囲読みする
+TAG_POSTING = "SELECT lt.lora_id FROM lora_tag lt JOIN tag t ON t.id = lt.tag_id WHERE t.name"
+
+def search_filter(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS):
+    # 検索条件は件数・ページ・ランダム・件数集計で共通。(FROM句, WHERE句, params) を返す
+    fts_query, short_terms = build_fts_query(q)
+    where = []
+    params = []
+    
+    if selected_kinds:
+        where.append("lora.kind_norm IN ({})".format(
+            ",".join(["?"] * len(selected_kinds))
+        ))
+        params.extend(selected_kinds)
+    
+    from_sql = "FROM lora"
+    if fts_query:
+        from_sql += " JOIN lora_fts ON lora_fts.rowid = lora.id"
+        where.append("lora_fts MATCH ?")
+        params.append(fts_query)
+    
+    for t in short_terms:
+        # 主キー (gram, lora_id) の範囲読みだけで済む
+        where.append("lora.id IN (SELECT lora_id FROM lora_gram WHERE gram = lower(?))")
+        params.append(t)
+    
+    for name in tags.require:
+        where.append(f"lora.id IN ({TAG_POSTING} = ?)")
+        params.append(name)
+    if tags.either:
+        qmarks = ",".join(["?"] * len(tags.either))
+        where.append(f"lora.id IN ({TAG_POSTING} IN ({qmarks}))")
+        params.extend(tags.either)
+    if tags.exclude:
+        qmarks = ",".join(["?"] * len(tags.exclude))
+        where.append(f"lora.id NOT IN ({TAG_POSTING} IN ({qmarks}))")
+        params.extend(tags.exclude)
+    
+    return from_sql, where, params
+
+def sort_key(sort_col: str, sort_dir: str):
+    # sort_title/kind_norm は生成列。並び順は (キー, id) のインデックスをそのまま前後に読む
+    # 戻り値: (列, 照合順序の指定, 向き)
+    sort_dir = "DESC" if sort_dir.upper() != "ASC" else "ASC"
+    if sort_col == "title":
+        return "lora.sort_title", " COLLATE NOCASE", sort_dir
+    return "lora.mtime", "", sort_dir
+
+def count_hits(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS) -> int:
+    key = ("count", q, tuple(selected_kinds), tags)
+    gen, total = search_cache().get(key)
+    if total is None:
+        total = count_hits_uncached(q, selected_kinds, tags)
+        search_cache().put(key, total, gen, key_bytes(key) + 32)
+    return total
+
+def count_hits_uncached(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS) -> int:
+    from_sql, where, params = search_filter(q, selected_kinds, tags)
+    sql = f"SELECT count(*) {from_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    
+    with reader() as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+def search_facets(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS) -> dict:
+    # 絞り込み候補の件数。{"kinds": {kind: 件数}, "tags": [(tag, 件数), ...]}
+    # 種別の件数は種別フィルタを外した条件で数える（他の種別を足したら何件増えるか分かるように）
+    key = ("facets", q, tuple(selected_kinds), tags)
+    gen, facets = search_cache().get(key)
+    if facets is None:
+        facets = search_facets_uncached(q, selected_kinds, tags)
+        nbytes = key_bytes(key) + sum(sys.getsizeof(k) + 64 for k in facets["kinds"]) \
+            + sum(sys.getsizeof(t) + 64 for t, _ in facets["tags"])
+        search_cache().put(key, facets, gen, nbytes)
+    return facets
+
+def search_facets_uncached(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS) -> dict:
+    with reader() as conn:
+        from_sql, where, params = search_filter(q, [], tags)
+        sql = f"SELECT lora.kind_norm AS k, count(*) {from_sql}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY k"
+        kinds = dict(conn.execute(sql, params).fetchall())
+        
+        from_sql, where, params = search_filter(q, selected_kinds, tags)
+        if not where:
+            # 絞り込みなしはトリガーで数えてある tag_stat を読むだけ
+            tags = conn.execute("""
+                SELECT t.name, s.lora_count
+                FROM tag_stat s JOIN tag t ON t.id = s.tag_id
+                WHERE s.lora_count > 0
+                ORDER BY s.lora_count DESC, t.name
+                LIMIT ?
+            """, (FACET_TAGS,)).fetchall()
+            return {"kinds": kinds, "tags": tags}
+        
+        hits = f"SELECT lora.id {from_sql} WHERE " + " AND ".join(where)
+        tags = conn.execute(f"""
+            SELECT t.name, c.n
+            FROM (
+                SELECT lt.tag_id, count(*) AS n
+                FROM lora_tag lt
+                WHERE lt.lora_id IN ({hits})
+                GROUP BY lt.tag_id
+                ORDER BY n DESC, lt.tag_id
+                LIMIT ?
+            ) c
+            JOIN tag t ON t.id = c.tag_id
+            ORDER BY c.n DESC, t.name
+        """, params + [FACET_TAGS]).fetchall()
+    return {"kinds": kinds, "tags": tags}
+
+def search_page(q: str, selected_kinds: list[str], sort_col: str, sort_dir: str, after=None, limit: int = PAGE_SIZE, tags: TagFilter = NO_TAGS):
+    # キャッシュにはページのid列とカーソルだけ持ち、行は主キーで読み直す
+    key = ("page", q, tuple(selected_kinds), sort_col, sort_dir, after, limit, tags)
+    gen, hit = search_cache().get(key)
+    if hit is not None:
+        ids, cursor = hit
+        return fetch_rows(ids), cursor
+    
+    rows, cursor = search_page_uncached(q, selected_kinds, sort_col, sort_dir, after, limit, tags)
+    ids = array("q", (r[0] for r in rows))
+    search_cache().put(key, (ids, cursor), gen, key_bytes(key) + sys.getsizeof(ids) + sys.getsizeof(cursor))
+    return rows, cursor
+
+def page_sql(q: str, selected_kinds: list[str], sort_col: str, sort_dir: str, after=None, limit: int = PAGE_SIZE, tags: TagFilter = NO_TAGS):
+    # キーセットページングのSQL。after は前のページ最後の行の (sortキー, id)。
+    # 並びは (sortキー, id) を sort_dir の向きに。その続きだけを limit+1 件読む（1件多いのは次ページ判定用）
+    key_col, collate, sort_dir = sort_key(sort_col, sort_dir)
+    key_expr = key_col + collate
+    
+    cursor_where = []
+    cursor_params = []
+    if after is not None:
+        after_key, after_id = after
+        op = "<" if sort_dir == "DESC" else ">"
+        # 照合順序は右辺に付ける（左辺の列に付けるとインデックスの範囲読みにならない）
+        cursor_where.append(f"({key_col}, lora.id) {op} (?{collate}, ?)")
+        cursor_params.extend([after_key, after_id])
+    
+    kinds = list(dict.fromkeys(selected_kinds))
+    if len(kinds) > 1 and build_fts_query(q)[0] is None:
+        # 種別が複数だと IN のままではヒット全部を一時B-treeでソートする。種別ごとに
+        # (kind_norm, キー) のインデックスを順に読んで UNION ALL でマージすれば limit+1 件で止まる。
+        # 全文検索は種別の数だけ MATCH し直すことになるので、そのときは1本のまま
+        arms = []
+        params = []
+        for kind in kinds:
+            from_sql, where, arm_params = search_filter(q, [kind], tags)
+            arms.append(f"SELECT {ROW_COLS}, {key_expr} AS sort_key {from_sql} WHERE " + " AND ".join(where + cursor_where))
+            params += arm_params + cursor_params
+        sql = " UNION ALL ".join(arms) + f" ORDER BY sort_key{collate} {sort_dir}, id {sort_dir} LIMIT ?"
+        params.append(int(limit) + 1)
+        return sql, params
+    
+    from_sql, where, params = search_filter(q, kinds, tags)
+    where += cursor_where
+    params += cursor_params
+    sql = f"SELECT {ROW_COLS}, {key_expr} {from_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {key_expr} {sort_dir}, lora.id {sort_dir} LIMIT ?"
+    params.append(int(limit) + 1)
+    return sql, params
+
+def search_page_uncached(q: str, selected_kinds: list[str], sort_col: str, sort_dir: str, after=None, limit: int = PAGE_SIZE, tags: TagFilter = NO_TAGS):
+    # 戻り値は (rows, 次ページのカーソル or None)
+    sql, params = page_sql(q, selected_kinds, sort_col, sort_dir, after, limit, tags)
+    with reader() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    
+    more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = (rows[-1][-1], rows[-1][0]) if more and rows else None
+    return [r[:-1] for r in rows], cursor
+
+# kind_norm 先頭のインデックスを読むだけで済む（check_query_plans も同じSQLを見る）
+KINDS_SQL = "SELECT DISTINCT kind_norm FROM lora"
+
+def check_query_plans() -> list[str]:
+    # 全文検索を使わないページ読み・件数集計が、インデックス順に読めていて一時B-treeでソートしていないか。
+    # カーソル付きのページは (キー, id) の範囲読みになっているかも見る。問題のあったクエリの説明を返す（空なら OK）
+    problems = []
+    cursors = {"mtime": (0, 0), "title": ("", 0)}
+    cases = []
+    for sort_col in ("mtime", "title"):
+        for sort_dir in ("DESC", "ASC"):
+            for kinds in ([], ["char"], ["char", "style"]):
+                for after in (None, cursors[sort_col]):
+                    name = f"page {sort_col} {sort_dir} kinds={kinds} after={after is not None}"
+                    cases.append((name, *page_sql("", kinds, sort_col, sort_dir, after), after is not None))
+    cases.append(("kind facets", "SELECT lora.kind_norm AS k, count(*) FROM lora GROUP BY k", [], False))
+    cases.append(("kinds", KINDS_SQL, [], False))
+    
+    with reader() as conn:
+        for name, sql, params, ranged in cases:
+            plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            if any("TEMP B-TREE" in p for p in plan):
+                problems.append(f"{name}: sorts in a temp b-tree: " + " / ".join(plan))
+            elif ranged and not any(op in p for p in plan for op in ("<", ">")):
+                problems.append(f"{name}: cursor is not an index range: " + " / ".join(plan))
+    return problems
+
+def fetch_rows(ids):
+    # 主キーでまとめて読む。INは順序が崩れるのでids順に並べ直す
+    if not ids:
+        return []
+    qmarks = ",".join(["?"] * len(ids))
+    with reader() as conn:
+        rows = conn.execute(f"SELECT {ROW_COLS} FROM lora WHERE lora.id IN ({qmarks})", list(ids)).fetchall()
+    m = {r[0]: r for r in rows}
+    return [m[i] for i in ids if i in m]
+
+def random_row(q: str, selected_kinds: list[str], tags: TagFilter = NO_TAGS):
+    # 件数を数えてからOFFSETで1件。id一覧は作らない
+    total = count_hits(q, selected_kinds, tags)
+    if not total:
+        return None
+    
+    from_sql, where, params = search_filter(q, selected_kinds, tags)
+    sql = f"SELECT {ROW_COLS} {from_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY lora.id LIMIT 1 OFFSET ?"
+    params.append(random.randrange(total))
+    
+    with reader() as conn:
+        return conn.execute(sql, params).fetchone()
+
+def fetch_kinds():
+    # 毎回の再実行で呼ばれるので検索と同じキャッシュに載せる
+    key = ("kinds",)
+    gen, kinds = search_cache().get(key)
+    if kinds is None:
+        kinds = fetch_kinds_uncached()
+        search_cache().put(key, kinds, gen, key_bytes(key) + sum(sys.getsizeof(k) for k in kinds))
+    return kinds
+
+def fetch_kinds_uncached():
+    # 種別は数個しかないので並べ替えはPythonで（SQLでNOCASE順にすると全件スキャン+一時B-treeになる）
+    with reader() as conn:
+        return sorted((r[0] for r in conn.execute(KINDS_SQL)), key=str.lower)
+
+def fetch_tags():
+    # 使われているタグ名（フィルタの選択肢）
+    key = ("tags",)
+    gen, tags = search_cache().get(key)
+    if tags is None:
+        with reader() as conn:
+            tags = [r[0] for r in conn.execute("""
+                SELECT t.name FROM tag t JOIN tag_stat s ON s.tag_id = t.id
+                WHERE s.lora_count > 0
+                ORDER BY t.name COLLATE NOCASE
+            """)]
+        search_cache().put(key, tags, gen, key_bytes(key) + sum(sys.getsizeof(t) for t in tags))
+    return tags
+
+def fetch_detail(lora_id: int) -> tuple[str | None, str | None]:
+    # 詳細表示のときだけ読む (info_json, meta_json)。移行前の行は lora の列に残っている
+    with reader() as conn:
+        row = conn.execute("""
+            SELECT b.info_z, b.meta_z, l.info_json, l.meta_json
+            FROM lora l LEFT JOIN lora_blob b ON b.lora_id = l.id
+            WHERE l.id = ?
+        """, (lora_id,)).fetchone()
+    if row is None:
+        return None, None
+    info_z, meta_z, info_json, meta_json = row
+    return unpack_json(info_z) or info_json, unpack_json(meta_z) or meta_json
+
+def fetch_latest_presets(lora_ids) -> dict:
+    # Pickした全LoRAの最新 body/outfit を1クエリで。
+    # {lora_id: (body_id, body_prompt, clothes_id, clothes_prompt)}、プリセットが無ければNone
+    lora_ids = list(lora_ids)
+    if not lora_ids:
+        return {}
+    
+    qmarks = ",".join(["?"] * len(lora_ids))
+    with reader() as conn:
+        rows = conn.execute(f"""
+            SELECT l.id,
+                (SELECT b.id FROM lora_body_preset b
+                 WHERE b.lora_id = l.id ORDER BY b.id DESC LIMIT 1),
+                (SELECT b.body_prompt FROM lora_body_preset b
+                 WHERE b.lora_id = l.id ORDER BY b.id DESC LIMIT 1),
+                (SELECT o.id FROM lora_outfit_preset o
+                 WHERE o.lora_id = l.id ORDER BY o.id DESC LIMIT 1),
+                (SELECT o.clothes_prompt FROM lora_outfit_preset o
+                 WHERE o.lora_id = l.id ORDER BY o.id DESC LIMIT 1)
+            FROM lora l
+            WHERE l.id IN ({qmarks})
+        """, lora_ids).fetchall()
+    return {r[0]: r[1:] for r in rows}
+
+def lora_tag(name: str, w: float):
+    # A1111の <lora:NAME:W>
+    safe = name.replace(":", "_")
+    return f"<lora:{safe}:{w:.2f}>"
+
+def recipe_generate(name, weight: float, body_prompt: str | None, clothes_prompt: str | None):
+    parts = []
+    parts.append(lora_tag(name, weight))
+    
+    if body_prompt:
+        parts.append("\n" + body_prompt)
+    if clothes_prompt:
+        parts.append("\n" + clothes_prompt)
+        
+    final_prompt = ", ".join(parts)
+    return final_prompt
+
+def build_prompt(items) -> str:
+    # items: [(lora_id, weight), ...]。それぞれ最新プリセットでレシピを作り、空行でつなぐ
+    ids = [lora_id for lora_id, _ in items]
+    rows = {r[0]: r for r in fetch_rows(ids)}
+    presets = fetch_latest_presets(ids)
+    out = []
+    for lora_id, weight in items:
+        row = rows.get(lora_id)
+        if row is None:
+            continue
+        _, body_prompt, _, clothes_prompt = presets.get(lora_id, (None, None, None, None))
+        out.append(recipe_generate(row[1], weight, body_prompt, clothes_prompt))
+    return "\n\n".join(out)
+
+def update_body_prompt(id: int | None, lora_id: int, body_prompt: str | None):
+
+    if body_prompt is None:
+        return
+    
+    with writer() as conn:
+        if id is not None:
+            conn.execute(
+                """
+                UPDATE lora_body_preset 
+                SET body_prompt = ? 
+                WHERE id = ? AND lora_id = ? AND body_prompt IS NOT ?
+                """, 
+                (body_prompt, id, lora_id, body_prompt)
+            )
+        else:
+            conn.execute(
+                """
+                INSERT INTO lora_body_preset (lora_id, body_prompt) 
+                VALUES(?, ?)
+                """, 
+                (lora_id, body_prompt))
+
+def update_clothes_prompt(id: int | None, lora_id:int, clothes_prompt: str | None):
+
+    if clothes_prompt is None:
+        return
+        
+    with writer() as conn:
+        if id is not None:
+            conn.execute(
+                """
+                UPDATE lora_outfit_preset 
+                SET clothes_prompt = ? 
+                WHERE id = ? AND lora_id = ? AND clothes_prompt IS NOT ?
+                """, 
+                (clothes_prompt, id, lora_id, clothes_prompt)
+            )
+        else:
+            conn.execute(
+                """
+                INSERT INTO lora_outfit_preset (lora_id, clothes_prompt) 
+                VALUES(?, ?)
+                """, 
+                (lora_id, clothes_prompt))
+
+def update_title(lora_id: int, title: str):
+    if title is None:
+        return
+    
+    # lora と lora_fts を同じトランザクションで更新する（writer()が抜けるときにcommit）
+    with writer() as conn:
+        conn.execute("BEGIN")
+        conn.execute("UPDATE lora SET title=? WHERE id=?", (title, lora_id))
+        refresh_fts(conn, [lora_id])
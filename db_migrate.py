@@ -1,4 +1,8 @@
+import sys
+import time
+import zlib
 import sqlite3
+import argparse
 from pathlib import Path
 
 def get_schema_version(conn) -> int:
@@ -20,39 +24,141 @@ def set_schema_version(conn, v: int):
         (str(v),)
     )
     
-def mig_001_fill_kind_from_path(conn):
-    rows = conn.execute(
-        "SELECT id, path FROM lora WHERE kind IS NULL OR kind=''"
-    ).fetchall()
-    
-    for _id, p in rows:
-        parent = Path(p).parent.name
-        kind = parent if parent else "Unsorted"
-        conn.execute("UPDATE lora SET kind=? WHERE id=?", (kind, _id))
+FTS_CHUNK = 500
 
-def mig_002_fill_fts(conn):
-    conn.execute("DROP TABLE IF EXISTS lora_fts")
-    conn.execute("""
-        CREATE VIRTUAL TABLE lora_fts USING fts5(
-            name, trigger, notes, tags_text, title,
-            tokenize = "trigram"
-        )
-    """)
+def refresh_fts(conn, ids=None):
+    # 検索インデックスの更新はここに集約する。idsの行を lora/lora_tag から作り直す（Noneなら全件）。
+    # lora側に無いidは削除だけされる
+    refresh_fts_table(conn, ids)
+    refresh_grams(conn, ids)
 
-    conn.execute("""
+def refresh_fts_table(conn, ids=None):
+    select = """
         INSERT INTO lora_fts(rowid, name, trigger, notes, tags_text, title)
         SELECT
-            l.id AS rowid,
+            l.id,
             COALESCE(l.name, ''),
             COALESCE(l.trigger, ''),
             COALESCE(l.notes, ''),
-            COALESCE(group_concat(t.name, ' '), '') AS tags_text,
+            COALESCE((
+                SELECT group_concat(name, ' ') FROM (
+                    SELECT t.name FROM lora_tag lt JOIN tag t ON t.id = lt.tag_id
+                    WHERE lt.lora_id = l.id ORDER BY lt.tag_id
+                )
+            ), ''),
             COALESCE(l.title, '')
         FROM lora l
-        LEFT JOIN lora_tag lt ON lt.lora_id = l.id
-        LEFT JOIN tag t ON t.id = lt.tag_id
-        GROUP BY l.id
+    """
+    if ids is None:
+        conn.execute("DELETE FROM lora_fts")
+        conn.execute(select)
+        return
+    
+    ids = list(ids)
+    for i in range(0, len(ids), FTS_CHUNK):
+        chunk = ids[i:i+FTS_CHUNK]
+        qmarks = ",".join(["?"] * len(chunk))
+        conn.execute(f"DELETE FROM lora_fts WHERE rowid IN ({qmarks})", chunk)
+        conn.execute(select + f" WHERE l.id IN ({qmarks})", chunk)
+
+GRAM_MAX = 2  # trigramで引けない長さ（1〜2文字）は lora_gram で引く
+
+def refresh_grams(conn, ids=None):
+    # name/title の1〜2文字の部分文字列を lora_gram に展開する（小文字化・空白を含むものは除く）
+    filt = ""
+    chunks = [None]
+    if ids is None:
+        conn.execute("DELETE FROM lora_gram")
+    else:
+        ids = list(ids)
+        chunks = [ids[i:i+FTS_CHUNK] for i in range(0, len(ids), FTS_CHUNK)]
+    
+    for chunk in chunks:
+        params = []
+        if chunk is not None:
+            qmarks = ",".join(["?"] * len(chunk))
+            conn.execute(f"DELETE FROM lora_gram WHERE lora_id IN ({qmarks})", chunk)
+            filt = f"WHERE id IN ({qmarks})"
+            params = chunk + chunk
+        conn.execute(f"""
+            INSERT OR IGNORE INTO lora_gram(gram, lora_id)
+            WITH RECURSIVE
+            src(id, s) AS (
+                SELECT id, lower(COALESCE(name, '')) FROM lora {filt}
+                UNION
+                SELECT id, lower(COALESCE(title, '')) FROM lora {filt}
+            ),
+            pos(id, s, i) AS (
+                SELECT id, s, 1 FROM src WHERE s <> ''
+                UNION ALL
+                SELECT id, s, i + 1 FROM pos WHERE i < length(s)
+            ),
+            lens(n) AS (
+                SELECT 1
+                UNION ALL
+                SELECT n + 1 FROM lens WHERE n < {GRAM_MAX}
+            ),
+            grams(gram, id) AS (
+                SELECT substr(s, i, n), id
+                FROM pos JOIN lens
+                WHERE i + n - 1 <= length(s)
+            )
+            SELECT gram, id FROM grams WHERE instr(gram, ' ') = 0
+        """, params)
+
+BLOB_ZLEVEL = 6
+
+def pack_json(text: str | None) -> bytes | None:
+    # info/metadata のJSONは lora_blob に圧縮して置く
+    return zlib.compress(text.encode("utf-8"), BLOB_ZLEVEL) if text else None
+
+def unpack_json(blob: bytes | None) -> str | None:
+    return zlib.decompress(blob).decode("utf-8") if blob else None
+
+def move_json_to_blob(conn, ids):
+    # lora.info_json/meta_json を lora_blob へ移して元の列はNULLにする（移し済みの行は飛ばす）
+    ids = list(ids)
+    for i in range(0, len(ids), FTS_CHUNK):
+        chunk = ids[i:i+FTS_CHUNK]
+        qmarks = ",".join(["?"] * len(chunk))
+        rows = conn.execute(f"""
+            SELECT id, info_json, meta_json FROM lora
+            WHERE id IN ({qmarks}) AND (info_json IS NOT NULL OR meta_json IS NOT NULL)
+        """, chunk).fetchall()
+        conn.executemany("""
+            INSERT INTO lora_blob(lora_id, info_z, meta_z) VALUES(?, ?, ?)
+            ON CONFLICT(lora_id) DO UPDATE SET info_z=excluded.info_z, meta_z=excluded.meta_z
+        """, [(lora_id, pack_json(info), pack_json(meta)) for lora_id, info, meta in rows])
+        conn.executemany(
+            "UPDATE lora SET info_json=NULL, meta_json=NULL WHERE id=?",
+            [(r[0],) for r in rows]
+        )
+
+def optimize_fts(conn):
+    # 大量更新の後にセグメントをまとめる
+    conn.execute("INSERT INTO lora_fts(lora_fts) VALUES('optimize')")
+
+def path_parent_name(p):
+    parent = Path(p).parent.name if p else ""
+    return parent if parent else "Unsorted"
+
+def mig_001_fill_kind_from_path(conn):
+    # 1行ずつではなくUPDATE 1本で。親フォルダ名はPython側の関数で出す
+    conn.create_function("path_parent_name", 1, path_parent_name, deterministic=True)
+    conn.execute(
+        "UPDATE lora SET kind = path_parent_name(path) WHERE kind IS NULL OR kind=''"
+    )
+
+def mig_002_fill_fts(conn):
+    conn.execute("DROP TABLE IF EXISTS lora_fts")
+    conn.execute("""
+        CREATE VIRTUAL TABLE lora_fts USING fts5(
+            name, trigger, notes, tags_text, title,
+            tokenize = "trigram"
+        )
     """)
+    # 中身はバックフィルで少しずつ入れる
+    enqueue_backfill(conn, "fts")
 
 def mig_003_add_lora_preset_table(conn):
     conn.executescript("""
@@ -78,20 +184,261 @@ def mig_003_add_lora_preset_table(conn):
         CREATE INDEX IF NOT EXISTS idx_lora_outfit_preset_lora_id ON lora_outfit_preset(lora_id);
     """)
     
+def mig_004_add_fingerprint(conn):
+    # sha256はsha_pending=0のときだけ信用できる（未検証の行はNULL）
+    conn.execute("ALTER TABLE lora ADD COLUMN fingerprint TEXT")
+    conn.execute("ALTER TABLE lora ADD COLUMN sha_pending INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_sha_pending ON lora(id) WHERE sha_pending=1")
+
+def mig_005_add_scan_dir(conn):
+    # ディレクトリ単位のスナップショット。mtimeと件数が同じなら中のファイルはstatしない
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scan_dir (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            entries INTEGER NOT NULL
+        )
+    """)
+
+def mig_006_add_network_facts(conn):
+    # safetensorsヘッダから取ったrank/モジュール数。baseには推定したアーキテクチャが入る
+    conn.execute("ALTER TABLE lora ADD COLUMN net_rank INTEGER")
+    conn.execute("ALTER TABLE lora ADD COLUMN module_count INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_base ON lora(base)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_net_rank ON lora(net_rank)")
+    # 既存の行も次のスキャンで読み直させる
+    conn.execute("DELETE FROM scan_dir")
+
+def mig_007_latest_preset_index(conn):
+    # Picked欄は各LoRAの最新プリセットだけ読む。(lora_id, id DESC) に本文まで入れてテーブルを引かずに済ませる
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lora_body_preset_latest
+        ON lora_body_preset(lora_id, id DESC, body_prompt)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lora_outfit_preset_latest
+        ON lora_outfit_preset(lora_id, id DESC, clothes_prompt)
+    """)
+    # lora_id 単独のインデックスは上の先頭列で足りる
+    conn.execute("DROP INDEX IF EXISTS idx_lora_body_preset_lora_id")
+    conn.execute("DROP INDEX IF EXISTS idx_lora_outfit_preset_lora_id")
+
+def mig_008_add_short_gram(conn):
+    # trigramは3文字未満の語を引けないので、1〜2文字用の逆引き表を別に持つ
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lora_gram (
+            gram TEXT NOT NULL,
+            lora_id INTEGER NOT NULL,
+            PRIMARY KEY(gram, lora_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_gram_lora ON lora_gram(lora_id)")
+    enqueue_backfill(conn, "gram")
+
+def mig_009_kind_norm_index(conn):
+    # 種別の絞り込み・件数集計は COALESCE(NULLIF(kind,''),'Unsorted') で引くので式インデックスを張る
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lora_kind_norm
+        ON lora(COALESCE(NULLIF(kind, ''), 'Unsorted'))
+    """)
+
+def mig_010_add_tag_stat(conn):
+    # タグごとのLoRA数。lora_tag のトリガーで増減させるので、全件のタグ件数は集計し直さずに読める
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tag_stat (
+            tag_id INTEGER PRIMARY KEY,
+            lora_count INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS lora_tag_stat_ins AFTER INSERT ON lora_tag BEGIN
+            INSERT OR IGNORE INTO tag_stat(tag_id, lora_count) VALUES (NEW.tag_id, 0);
+            UPDATE tag_stat SET lora_count = lora_count + 1 WHERE tag_id = NEW.tag_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS lora_tag_stat_del AFTER DELETE ON lora_tag BEGIN
+            UPDATE tag_stat SET lora_count = lora_count - 1 WHERE tag_id = OLD.tag_id;
+        END
+    """)
+    conn.execute("DELETE FROM tag_stat")
+    conn.execute("""
+        INSERT INTO tag_stat(tag_id, lora_count)
+        SELECT tag_id, count(*) FROM lora_tag GROUP BY tag_id
+    """)
+
+def mig_011_tag_posting_index(conn):
+    # タグで絞り込むときにタグ→lora_idを引く。主キー (lora_id, tag_id) の逆向き
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_tag_tag ON lora_tag(tag_id, lora_id)")
+
+def mig_012_add_lora_blob(conn):
+    # 検索やページ表示で読む lora の行を細く保つため、大きいJSONは別表に圧縮して置く
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lora_blob (
+            lora_id INTEGER PRIMARY KEY,
+            info_z BLOB,
+            meta_z BLOB,
+            FOREIGN KEY(lora_id) REFERENCES lora(id) ON DELETE CASCADE
+        )
+    """)
+    enqueue_backfill(conn, "blob")
+
+def mig_013_sort_columns(conn):
+    # 検索の並び・種別の式を生成列にして、(キー, id) の順に読めるインデックスを張る。
+    # どのインデックスにも末尾にrowid(=id)が入るので、id での同順ソートもそのまま使える
+    conn.execute("""
+        ALTER TABLE lora ADD COLUMN sort_title TEXT
+        GENERATED ALWAYS AS (COALESCE(NULLIF(title, ''), name)) VIRTUAL
+    """)
+    conn.execute("""
+        ALTER TABLE lora ADD COLUMN kind_norm TEXT
+        GENERATED ALWAYS AS (COALESCE(NULLIF(kind, ''), 'Unsorted')) VIRTUAL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_sort_title ON lora(sort_title COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_kind_mtime ON lora(kind_norm, mtime)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_kind_title ON lora(kind_norm, sort_title COLLATE NOCASE)")
+    # 式インデックス(V9)は kind_norm 先頭のインデックスで足りる
+    conn.execute("DROP INDEX IF EXISTS idx_lora_kind_norm")
+
+def mig_014_module_count_index(conn):
+    # V6 で入れたモジュール数だけインデックスが無かった（rank/baseと同じく絞り込み・並べ替えに使う）
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_module_count ON lora(module_count)")
 
 MIGRATIONS = [
     (1, mig_001_fill_kind_from_path),
     (2, mig_002_fill_fts),
-    (3, mig_003_add_lora_preset_table)
+    (3, mig_003_add_lora_preset_table),
+    (4, mig_004_add_fingerprint),
+    (5, mig_005_add_scan_dir),
+    (6, mig_006_add_network_facts),
+    (7, mig_007_latest_preset_index),
+    (8, mig_008_add_short_gram),
+    (9, mig_009_kind_norm_index),
+    (10, mig_010_add_tag_stat),
+    (11, mig_011_tag_posting_index),
+    (12, mig_012_add_lora_blob),
+    (13, mig_013_sort_columns),
+    (14, mig_014_module_count_index),
 ]
 
-def apply_migrations(conn):
+# ---- バックフィル ----
+# 行数に比例する重いデータ移行はスキーマ変更と分けて、idの範囲ごとに別トランザクションで進める。
+# 進み具合は schema_meta の backfill.<名前> に最後に処理したidとして残すので、途中で止めても続きから再開できる。
+# マイグレーションは enqueue_backfill で登録するだけ（スキーマ変更と同じトランザクション）。
+
+BACKFILL_CHUNK = 2000
+
+# どのマイグレーションがどのバックフィルを登録するか（--plan の表示用）
+BACKFILL_QUEUED_BY = {"fts": 2, "gram": 8, "blob": 12}
+
+BACKFILLS = {
+    # 名前: fn(conn, ids)
+    "fts": refresh_fts_table,
+    "gram": refresh_grams,
+    "blob": move_json_to_blob,
+}
+
+def enqueue_backfill(conn, name: str):
+    conn.execute(
+        "INSERT INTO schema_meta(key, value) VALUES(?, '0') "
+        "ON CONFLICT(key) DO UPDATE SET value='0'",
+        (f"backfill.{name}",)
+    )
+
+def pending_backfills(conn) -> list[tuple[str, int]]:
+    if not table_exists(conn, "schema_meta"):
+        return []
+    rows = conn.execute(
+        "SELECT key, value FROM schema_meta WHERE key LIKE 'backfill.%' AND value <> 'done' ORDER BY key"
+    ).fetchall()
+    return [(k[len("backfill."):], int(v)) for k, v in rows]
+
+def run_backfill_chunk(conn, name: str, chunk: int = BACKFILL_CHUNK) -> tuple[int, bool]:
+    # 1チャンク分だけ進める。(処理した行数, 終わったか)
+    key = f"backfill.{name}"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT value FROM schema_meta WHERE key=?", (key,)).fetchone()
+        if row is None or row[0] == "done":
+            conn.rollback()
+            return 0, True
+        
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM lora WHERE id > ? ORDER BY id LIMIT ?", (int(row[0]), chunk)
+        )]
+        if ids:
+            BACKFILLS[name](conn, ids)
+        conn.execute(
+            "UPDATE schema_meta SET value=? WHERE key=?",
+            (str(ids[-1]) if ids else "done", key)
+        )
+        conn.commit()
+        return len(ids), not ids
+    except Exception:
+        conn.rollback()
+        raise
+
+def run_backfills(conn, chunk: int = BACKFILL_CHUNK, progress=print, stop=None) -> bool:
+    # 残っているバックフィルを全部流す。stop(threading.Event)が立ったらチャンクの区切りで抜ける。
+    # 全部終わったらTrue
+    for name, last_id in pending_backfills(conn):
+        remaining = conn.execute("SELECT count(*) FROM lora WHERE id > ?", (last_id,)).fetchone()[0]
+        done = 0
+        t0 = time.perf_counter()
+        while True:
+            if stop is not None and stop.is_set():
+                return False
+            n, finished = run_backfill_chunk(conn, name, chunk)
+            done += n
+            if finished:
+                break
+            if progress:
+                pct = 100 * done // max(1, remaining)
+                progress(f"[backfill] {name} {done}/{remaining} ({pct}%) {time.perf_counter() - t0:.1f}s")
+        if progress:
+            progress(f"[backfill] {name} OK ({done} rows, {time.perf_counter() - t0:.2f}s)")
+    return True
+
+# ---- スキーマ ----
+
+def migration_plan(conn) -> list[str]:
+    # これから何が走るか（dry-run用）
+    cur = get_schema_version(conn)
+    lines = [f"schema V{cur} -> V{MIGRATIONS[-1][0]}" if cur < MIGRATIONS[-1][0] else f"schema V{cur} (up to date)"]
+    for ver, fn in MIGRATIONS:
+        if ver > cur:
+            lines.append(f"  V{ver} {fn.__name__}")
+    
+    rows = conn.execute("SELECT count(*) FROM lora").fetchone()[0] if table_exists(conn, "lora") else 0
+    pending = pending_backfills(conn)
+    for name, last_id in pending:
+        left = conn.execute("SELECT count(*) FROM lora WHERE id > ?", (last_id,)).fetchone()[0]
+        lines.append(f"  backfill {name}: {left} rows left (from id>{last_id})")
+    # これから走るマイグレーションが登録するバックフィルは全行が対象
+    for name, ver in BACKFILL_QUEUED_BY.items():
+        if ver > cur and name not in dict(pending):
+            lines.append(f"  backfill {name}: {rows} rows (queued by V{ver})")
+    return lines
+
+def table_exists(conn, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+    ).fetchone() is not None
+
+def apply_migrations(conn, dry_run: bool = False):
+    # スキーマ変更だけ。重いデータ移行は run_backfills で別に流す
+    if dry_run:
+        for line in migration_plan(conn):
+            print(line)
+        return
+    
     cur = get_schema_version(conn)
     
     for ver, fn in MIGRATIONS:
         if ver <= cur:
             continue
         
+        t0 = time.perf_counter()
         conn.execute("BEGIN")
         try:            
             fn(conn)
@@ -99,7 +446,40 @@ def apply_migrations(conn):
             set_schema_version(conn, ver)
             conn.commit()
             cur = ver
-            print(f"[migrate] -> V{ver} OK")
+            print(f"[migrate] -> V{ver} OK ({time.perf_counter() - t0:.2f}s)")
         except Exception as e:
             conn.rollback()
             raise RuntimeError(f"migration v{ver} failed: {e}") from e
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="カタログDBのマイグレーション")
+    ap.add_argument("db", nargs="?", type=Path, help="DBファイル（省略時は catalog_db.DB_PATH）")
+    ap.add_argument("--plan", action="store_true", help="何が走るかだけ表示する（dry-run）")
+    ap.add_argument("--no-backfill", action="store_true", help="スキーマ変更だけ行う")
+    ap.add_argument("--chunk", type=int, default=BACKFILL_CHUNK)
+    ap.add_argument("--vacuum", action="store_true", help="最後にVACUUMして空いたページを返す（JSONを移した後など）")
+    args = ap.parse_args()
+    
+    if args.db is None:
+        from catalog_db import DB_PATH
+        args.db = DB_PATH
+    if not args.db.exists():
+        sys.exit(f"not found: {args.db}")
+    
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        apply_migrations(conn, dry_run=args.plan)
+        if not args.plan and not args.no_backfill:
+            run_backfills(conn, chunk=args.chunk)
+        if args.vacuum and not args.plan:
+            # WALだと書き直したページはまだ -wal にあるので、本体に戻してからサイズを測る
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            before = args.db.stat().st_size
+            t0 = time.perf_counter()
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            print(f"[vacuum] {before / 2**20:.1f}MB -> {args.db.stat().st_size / 2**20:.1f}MB ({time.perf_counter() - t0:.2f}s)")
+    finally:
+        conn.close()
@@ -1,29 +1,182 @@
-import os, json, time, sqlite3, hashlib
+import os, sys, json, time, signal, sqlite3, hashlib, argparse, tempfile, threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 from PIL import Image
-from db_migrate import apply_migrations
+from db_migrate import apply_migrations, run_backfills, refresh_fts, optimize_fts, pack_json, FTS_CHUNK
 
-# 任意：無くても動く
+# 任意：無ければwatchはポーリングで動く
 try:
-    from safetensors import safe_open
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
 except Exception:
-    safe_open = None
+    Observer = None
 
-LORA_ROOT = Path(r"E:\AIDirectory\EasyReforge\Model\Lora")  # 変える
+# LORA_ROOT は環境変数で差し替えられる（ベンチや別ライブラリ用）
+LORA_ROOT = Path(os.environ.get("LORA_ROOT", r"E:\AIDirectory\EasyReforge\Model\Lora"))  # 変える
 DB_PATH   = LORA_ROOT / "__lora_catalog.sqlite"
 THUMB_DIR = LORA_ROOT / "__thumbs__"
 THUMB_SIZE = 320
 THUMB_QUALITY = 70
+THUMB_WORKERS = min(4, os.cpu_count() or 2)
 
-def sha256_file(path: Path, chunk=1024*1024):
+# 速度/画質のプロファイル。reducing_gapを指定すると先にreduce()で整数倍縮小してからリサンプルする
+THUMB_PROFILE = "fast"
+THUMB_PROFILES = {
+    "fast":     {"method": 2, "reducing_gap": 2.0,  "resample": Image.BILINEAR},
+    "balanced": {"method": 4, "reducing_gap": 3.0,  "resample": Image.BICUBIC},
+    "quality":  {"method": 6, "reducing_gap": None, "resample": Image.LANCZOS},
+}
+
+# ハッシュ計算のワーカー設定（"thread" / "process"）
+HASH_WORKERS = min(8, os.cpu_count() or 4)
+HASH_EXECUTOR = "thread"
+
+# 高速モード: 全体ハッシュの代わりにサイズ+先頭/末尾/途中ブロックのfingerprintで判定し、
+# sha256は後から検証パスで埋める
+FAST_FINGERPRINT = False
+FINGERPRINT_BLOCK = 64 * 1024
+FINGERPRINT_SAMPLES = 4
+
+# watchモード
+WATCH_DEBOUNCE_SEC = 2.0
+WATCH_POLL_SEC = 5.0
+WATCH_EVENTS = ("created", "deleted", "moved", "modified", "closed")
+WATCH_SUFFIXES = (".safetensors", ".metadata.json", ".preview.png", ".info", ".png")
+
+class ScanProfiler:
+    # フェーズ別の所要時間とカウンタ。ファイル単位のフェーズはp50/p95も出す
+    def __init__(self):
+        self.started = time.time()
+        self.times = defaultdict(list)
+        self.counters = defaultdict(int)
+    
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name].append(time.perf_counter() - t0)
+    
+    def add(self, name: str, seconds: float):
+        self.times[name].append(seconds)
+    
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+    
+    def report(self) -> dict:
+        def pct(xs, q):
+            return xs[min(len(xs) - 1, int(round(q * (len(xs) - 1))))]
+        
+        phases = {}
+        for name, xs in self.times.items():
+            xs = sorted(xs)
+            phases[name] = {
+                "total_s": sum(xs),
+                "n": len(xs),
+                "p50_ms": pct(xs, 0.50) * 1000,
+                "p95_ms": pct(xs, 0.95) * 1000,
+                "max_ms": xs[-1] * 1000,
+            }
+        counters = dict(self.counters)
+        hash_s = phases.get("hash", {}).get("total_s", 0)
+        if hash_s:
+            counters["hash_mb_per_s_per_worker"] = counters.get("bytes_hashed", 0) / hash_s / 1e6
+        return {"started": self.started, "wall_s": time.time() - self.started, "phases": phases, "counters": counters}
+    
+    def print_summary(self):
+        rep = self.report()
+        print(f"[profile] wall={rep['wall_s']:.3f}s")
+        print(f"  {'phase':<14}{'total(s)':>10}{'n':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'max(ms)':>10}")
+        for name, ph in sorted(rep["phases"].items(), key=lambda kv: -kv[1]["total_s"]):
+            print(f"  {name:<14}{ph['total_s']:>10.3f}{ph['n']:>8}{ph['p50_ms']:>10.2f}{ph['p95_ms']:>10.2f}{ph['max_ms']:>10.2f}")
+        for name, v in sorted(rep["counters"].items()):
+            print(f"  {name} = {v:.1f}" if isinstance(v, float) else f"  {name} = {v}")
+
+class NullProfiler:
+    # 計測しない時はこっち。何もしない
+    _ctx = nullcontext()
+    
+    def phase(self, name):
+        return self._ctx
+    
+    def add(self, name, seconds):
+        pass
+    
+    def count(self, name, n=1):
+        pass
+
+# main(profile=True) の間だけScanProfilerに差し替わる
+prof = NullProfiler()
+
+# Ctrl-C/SIGTERM で立つ。スキャンはバッチの区切りで書けた所までコミットして抜ける
+stop_requested = threading.Event()
+
+@contextmanager
+def stop_on_signal():
+    # main の間だけ割り込みを「止まってほしい」の合図として扱う。2回目は今まで通り即中断
+    def handler(signum, frame):
+        if stop_requested.is_set():
+            raise KeyboardInterrupt
+        stop_requested.set()
+        print(f"\n[scan] {signal.Signals(signum).name}: stopping after the current batch (again to abort)")
+    
+    stop_requested.clear()
+    sigs = [signal.SIGINT, signal.SIGTERM] + ([signal.SIGBREAK] if hasattr(signal, "SIGBREAK") else [])
+    # ハンドラはメインスレッドでしか設定できない（別スレッドから呼ばれた時は今まで通り）
+    main_thread = threading.current_thread() is threading.main_thread()
+    old = {s: signal.signal(s, handler) for s in sigs} if main_thread else {}
+    try:
+        yield stop_requested
+    finally:
+        for s, h in old.items():
+            signal.signal(s, h)
+
+def pool_stop(pool):
+    # threadのワーカーには中断フラグを渡せる（processには渡せないので今のファイルは最後まで読む）
+    return stop_requested if isinstance(pool, ThreadPoolExecutor) else None
+
+def sha256_file(path: Path, chunk=1024*1024, stop=None):
+    # stop が立ったら途中で諦めて None（hashlibの途中状態は保存できないので次回は最初から）
     h = hashlib.sha256()
     with path.open("rb") as f:
         while True:
+            if stop is not None and stop.is_set():
+                return None
             b = f.read(chunk)
             if not b: break
             h.update(b)
     return h.hexdigest()
 
+def fingerprint_file(path: Path, block=FINGERPRINT_BLOCK, samples=FINGERPRINT_SAMPLES):
+    size = path.stat().st_size
+    h = hashlib.blake2b(digest_size=16)
+    h.update(size.to_bytes(8, "little"))
+    with path.open("rb") as f:
+        if size <= block * (samples + 2):
+            h.update(f.read())
+        else:
+            offsets = [size * k // (samples + 1) for k in range(samples + 1)] + [size - block]
+            for off in offsets:
+                f.seek(off)
+                h.update(f.read(block))
+    return f"{size:x}-{h.hexdigest()}"
+
+def hash_file(path: Path, full: bool = True, stop=None):
+    # ワーカー側で実行する。(fingerprint, sha256 or None, 秒数, 読んだバイト数)
+    # 中断でshaが取れなかったファイルは fingerprint だけで登録され、sha_pending として検証に回る
+    t0 = time.perf_counter()
+    fp = fingerprint_file(path)
+    size = path.stat().st_size
+    nbytes = min(size, FINGERPRINT_BLOCK * (FINGERPRINT_SAMPLES + 2))
+    sha = None
+    if full:
+        sha = sha256_file(path, stop=stop)
+        nbytes += size if sha else 0
+    return fp, sha, time.perf_counter() - t0, nbytes
+
 def read_text_json(path: Path):
     if not path.exists():
         return None
@@ -32,27 +185,99 @@ def read_text_json(path: Path):
     except Exception:
         return None
 
-def read_safetensors_metadata(path: Path):
-    if safe_open is None:
-        return {}
+SAFETENSORS_MAX_HEADER = 100 * 1024 * 1024
+
+def read_safetensors_header(path: Path) -> dict:
+    # 先頭8バイト(ヘッダ長, little endian u64) + JSONヘッダだけ読む。テンソル本体には触らない
     try:
-        with safe_open(str(path), framework="pt", device="cpu") as f:
-            return f.metadata() or {}
-    except Exception:
+        with path.open("rb") as f:
+            n = int.from_bytes(f.read(8), "little")
+            if not 0 < n <= SAFETENSORS_MAX_HEADER:
+                return {}
+            header = json.loads(f.read(n))
+    except (OSError, ValueError):
         return {}
+    return header if isinstance(header, dict) else {}
 
-def ensure_thumb(png_path: Path, sha: str):
-    THUMB_DIR.mkdir(parents=True, exist_ok=True)
-    out = THUMB_DIR / f"{sha}.webp"
+LORA_DOWN_SUFFIXES = (".lora_down.weight", ".lora_A.weight", ".hada_w1_b", ".lokr_w1")
+CROSS_ATTN_ARCH = {768: "SD1.5", 1024: "SD2", 2048: "SDXL"}
+
+def guess_arch(md: dict, tensors: dict) -> str | None:
+    v = str(md.get("ss_base_model_version") or "").lower()
+    if v:
+        for key, arch in (("sdxl", "SDXL"), ("flux", "Flux"), ("sd3", "SD3"), ("v2", "SD2"), ("v1", "SD1.5")):
+            if key in v:
+                return arch
+    
+    keys = tensors.keys()
+    if any("double_blocks" in k or "single_transformer_blocks" in k for k in keys):
+        return "Flux"
+    if any("joint_blocks" in k for k in keys):
+        return "SD3"
+    # cross attentionのto_kの入力次元 = テキストエンコーダの出力次元
+    for k, t in tensors.items():
+        if ("attn2_to_k" in k or "attn2.to_k" in k) and k.endswith(LORA_DOWN_SUFFIXES[:2]):
+            shape = t.get("shape") or []
+            if len(shape) == 2 and shape[1] in CROSS_ATTN_ARCH:
+                return CROSS_ATTN_ARCH[shape[1]]
+    if any(k.startswith("lora_te2_") or "input_blocks" in k for k in keys):
+        return "SDXL"
+    if any(k.startswith("lora_te_") or "down_blocks" in k for k in keys):
+        return "SD1.5"
+    return None
+
+def network_facts(header: dict):
+    # 戻り値: (rank, モジュール数, アーキテクチャ推定 or None)
+    md = header.get("__metadata__")
+    md = md if isinstance(md, dict) else {}
+    tensors = {k: v for k, v in header.items() if k != "__metadata__" and isinstance(v, dict)}
+    
+    ranks = {}
+    modules = 0
+    for k, t in tensors.items():
+        if k.endswith(LORA_DOWN_SUFFIXES):
+            modules += 1
+            shape = t.get("shape") or []
+            if k.endswith(LORA_DOWN_SUFFIXES[:2]) and shape:
+                ranks[shape[0]] = ranks.get(shape[0], 0) + 1
+    
+    if ranks:
+        rank = max(ranks, key=ranks.get)
+    else:
+        try:
+            rank = int(md.get("ss_network_dim"))
+        except (TypeError, ValueError):
+            rank = None
+    return rank, modules, guess_arch(md, tensors)
+
+def thumb_path(key: str) -> Path:
+    return THUMB_DIR / f"{key}.webp"
+
+def ensure_thumb(png_path: Path, key: str, profile: str = THUMB_PROFILE):
+    # 戻り値: (サムネのパス or None, 生成にかかった秒数。既にあれば0)
+    out = thumb_path(key)
     if out.exists():
-        return out
+        return out, 0.0
+    
+    settings = THUMB_PROFILES[profile]
+    t0 = time.perf_counter()
+    # 同じキーのサムネを別スレッド/別プロセス(watch)が同時に作ることがあるので、書きかけは毎回別名にする
+    fd, tmp = tempfile.mkstemp(dir=THUMB_DIR, prefix=key + ".", suffix=".tmp")
+    os.close(fd)
+    tmp = Path(tmp)
     try:
-        img = Image.open(png_path).convert("RGB")
-        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
-        img.save(out, "WEBP", quality=THUMB_QUALITY, method=6)
-        return out
+        with Image.open(png_path) as img:
+            # JPEG中身のプレビューならデコード時点で縮小される
+            img.draft("RGB", (THUMB_SIZE, THUMB_SIZE))
+            if img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA")
+            img.thumbnail((THUMB_SIZE, THUMB_SIZE), settings["resample"], reducing_gap=settings["reducing_gap"])
+            img.convert("RGB").save(tmp, "WEBP", quality=THUMB_QUALITY, method=settings["method"])
+        os.replace(tmp, out)
+        return out, time.perf_counter() - t0
     except Exception:
-        return None
+        tmp.unlink(missing_ok=True)
+        return None, time.perf_counter() - t0
 
 def init_db(conn: sqlite3.Connection):
     # 接続設定
@@ -83,7 +308,7 @@ def init_db(conn: sqlite3.Connection):
     );
 
     CREATE VIRTUAL TABLE IF NOT EXISTS lora_fts
-    USING fts5(name, trigger, notes, tags_text, title
+    USING fts5(name, trigger, notes, tags_text, title,
         tokenize = "trigram"
     );
 
@@ -106,11 +331,13 @@ def init_db(conn: sqlite3.Connection):
 #    conn.commit()
 
 def upsert_lora(conn, row):
-    conn.execute("""
+    # row の info/meta（圧縮済み）は lora_blob に書き、lora の列はNULLにしておく
+    lora_id = conn.execute("""
     INSERT INTO lora(
       name,path,sha256,base,kind,trigger,notes,preview_full,preview_thumb,
-      info_json,meta_json,civitai_id,file_size,mtime,scanned_at,title
-    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+      info_json,meta_json,civitai_id,file_size,mtime,scanned_at,title,
+      fingerprint,sha_pending,net_rank,module_count
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
     ON CONFLICT(path) DO UPDATE SET
       name=excluded.name,
       sha256=excluded.sha256,
@@ -124,39 +351,59 @@ def upsert_lora(conn, row):
       civitai_id=excluded.civitai_id,
       file_size=excluded.file_size,
       mtime=excluded.mtime,
-      scanned_at=excluded.scanned_at
-    """, row)
-#    conn.commit()
-    return conn.execute("SELECT id FROM lora WHERE path=?", (row[1],)).fetchone()[0]
+      scanned_at=excluded.scanned_at,
+      fingerprint=excluded.fingerprint,
+      sha_pending=excluded.sha_pending,
+      net_rank=excluded.net_rank,
+      module_count=excluded.module_count
+    RETURNING id
+    """, row[:9] + (None, None) + row[11:]).fetchone()[0]
+    conn.execute("""
+    INSERT INTO lora_blob(lora_id, info_z, meta_z) VALUES(?,?,?)
+    ON CONFLICT(lora_id) DO UPDATE SET info_z=excluded.info_z, meta_z=excluded.meta_z
+    """, (lora_id, row[9], row[10]))
+    return lora_id
 
-def set_tags(conn, lora_id: int, tags: list[str]):
-    conn.execute("DELETE FROM lora_tag WHERE lora_id=?", (lora_id,))
-    for t in tags:
-        t = (t or "").strip()
-        if not t: 
-            continue
-        
-        conn.execute("INSERT OR IGNORE INTO tag(name, title) VALUES(?, ?)", (t,t))        
-        tag_id = conn.execute("SELECT id FROM tag WHERE name=?", (t,)).fetchone()[0]
-        conn.execute("INSERT OR REPLACE INTO lora_tag(lora_id, tag_id, weight) VALUES(?,?,1.0)", (lora_id, tag_id))
-#    conn.commit()
+def load_tag_ids(conn) -> dict:
+    # tag.name -> id。スキャン全体で使い回す
+    return {name: tag_id for tag_id, name in conn.execute("SELECT id, name FROM tag")}
 
-def fts_exists(conn, lora_id: int) -> bool:
-    row = conn.execute("SELECT 1 FROM lora_fts WHERE rowid=? LIMIT 1", (lora_id,)).fetchone()
-    return row is not None
-
-def sync_fts(conn, lora_id: int):
-    name, trigger, notes, title = conn.execute("SELECT name, trigger, notes, title FROM lora WHERE id=?", (lora_id,)).fetchone()
-    tags_text = conn.execute("""
-      SELECT COALESCE(group_concat(tag.name, ' '), '')
-      FROM lora_tag JOIN tag ON tag.id = lora_tag.tag_id
-      WHERE lora_tag.lora_id=?
-    """, (lora_id,)).fetchone()[0]
-    conn.execute(
-        "INSERT OR REPLACE INTO lora_fts(rowid, name, trigger, notes, tags_text, title) VALUES(?,?,?,?,?,?)",
-        (lora_id, name or "", trigger or "", notes or "", tags_text or "", title or "")
-    )
-#    conn.commit()
+def resolve_tag_ids(conn, tag_ids: dict, names) -> None:
+    missing = [n for n in names if n not in tag_ids]
+    if not missing:
+        return
+    conn.executemany("INSERT OR IGNORE INTO tag(name, title) VALUES(?, ?)", [(n, n) for n in missing])
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i+500]
+        qmarks = ",".join(["?"] * len(chunk))
+        tag_ids.update(
+            (name, tag_id) for tag_id, name in conn.execute(f"SELECT id, name FROM tag WHERE name IN ({qmarks})", chunk)
+        )
+
+def set_tags(conn, tag_ids: dict, items) -> set[int]:
+    # items: [(lora_id, tags), ...]。今のlora_tagとの差分だけ書く。戻り値はタグが変わったlora_id
+    new = {}
+    for lora_id, tags in items:
+        # 順序を保つ（新規タグのidは今まで通り出現順に振られる）
+        new[lora_id] = list(dict.fromkeys(t.strip() for t in tags if t and t.strip()))
+    resolve_tag_ids(conn, tag_ids, list(dict.fromkeys(t for names in new.values() for t in names)))
+    
+    old = {lora_id: set() for lora_id in new}
+    qmarks = ",".join(["?"] * len(new))
+    for lora_id, tag_id in conn.execute(f"SELECT lora_id, tag_id FROM lora_tag WHERE lora_id IN ({qmarks})", list(new)):
+        old[lora_id].add(tag_id)
+    
+    deletes = []
+    inserts = []
+    for lora_id, names in new.items():
+        want = {tag_ids[n] for n in names}
+        deletes += [(lora_id, t) for t in old[lora_id] - want]
+        inserts += [(lora_id, t) for t in want - old[lora_id]]
+    
+    conn.executemany("DELETE FROM lora_tag WHERE lora_id=? AND tag_id=?", deletes)
+    conn.executemany("INSERT INTO lora_tag(lora_id, tag_id, weight) VALUES(?,?,1.0)", inserts)
+    prof.count("tags_written", len(deletes) + len(inserts))
+    return {lora_id for lora_id, _ in deletes + inserts}
 
 def find_preview_png(stem: Path):
     p = stem.with_name(stem.name + ".preview.png")
@@ -169,14 +416,71 @@ def find_preview_png(stem: Path):
 
     return None
 
+def walk_tree(conn, full: bool = False):
+    # 戻り値: (全.safetensors, 前回スキャンから変化のないディレクトリ, 今回のスナップショット,
+    #          読めなかったディレクトリ, 全.pngのパス)
+    # ファイルの追加/削除/リネームはディレクトリのmtimeと件数に出るので、
+    # 変化のないディレクトリの中身はstatもDB照合もしない（上書き保存は--fullで拾う）
+    snap = {} if full else {
+        r[0]: (r[1], r[2]) for r in conn.execute("SELECT path, mtime_ns, entries FROM scan_dir")
+    }
+    files = []
+    previews = set()
+    unchanged = set()
+    new_snap = {}
+    failed = []
+    stack = [LORA_ROOT]
+    while stack:
+        d = stack.pop()
+        try:
+            mtime_ns = d.stat().st_mtime_ns
+            with os.scandir(d) as it:
+                entries = [e for e in it if e.path != str(THUMB_DIR) and not e.name.startswith(DB_PATH.name)]
+        except OSError:
+            failed.append(d)
+            continue
+        
+        new_snap[str(d)] = (mtime_ns, len(entries))
+        if snap.get(str(d)) == new_snap[str(d)]:
+            unchanged.add(d)
+        
+        for e in entries:
+            if e.is_dir():
+                stack.append(Path(e.path))
+            elif e.name.endswith(".safetensors"):
+                files.append(Path(e.path))
+            elif e.name.lower().endswith(".png"):
+                # Windowsでは大文字小文字を区別しない（find_preview_png の exists() と揃える）
+                previews.add(os.path.normcase(e.path))
+    
+    return sorted(files), unchanged, new_snap, failed, previews
+
+def save_dir_snapshot(conn, snap: dict):
+    conn.execute("DELETE FROM scan_dir")
+    conn.executemany(
+        "INSERT INTO scan_dir(path, mtime_ns, entries) VALUES(?,?,?)",
+        [(p, m, n) for p, (m, n) in snap.items()]
+    )
+
+def checkpoint_dirs(conn, snap: dict, dirs) -> None:
+    # 中のファイルを全部書き終えたディレクトリだけスナップショットを進める（コミットは呼び出し側）
+    conn.executemany(
+        "INSERT OR REPLACE INTO scan_dir(path, mtime_ns, entries) VALUES(?,?,?)",
+        [(d, *snap[d]) for d in dirs if d in snap]
+    )
+
 BATCH = 100
+FTS_OPTIMIZE_MIN = 1000  # これ以上更新したらスキャン後にFTSをoptimizeする
 
-def bump_commit(conn, pending: int, batch: int = BATCH) -> int:
-    pending += 1
-    if pending >= batch:
-        conn.commit()
-        return 0
-    return pending
+def make_executor(kind: str, workers: int):
+    # hashlibは大きなバッファではGILを解放するのでthreadで十分なことが多い
+    if kind == "process":
+        # Ctrl-Cはプロセスグループ全体に届く。ワーカーは無視して、止めるのは親に任せる
+        return ProcessPoolExecutor(max_workers=workers, initializer=signal.signal,
+                                   initargs=(signal.SIGINT, signal.SIG_IGN))
+    if kind != "thread":
+        raise ValueError(f"unknown executor: {kind}")
+    return ThreadPoolExecutor(max_workers=workers)
 
 last_print=0.0
 PRINT_INTERVAL_SEC = 0.5
@@ -191,31 +495,274 @@ def print_progress(done, total, skipped, phase="scan"):
     msg = f"\r[{phase}] {done}/{total} ({pct:5.1f}%) skipped:{skipped}"
     print(msg, end="", flush=True)
 
-def main():
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
-    apply_migrations(conn)
+def load_catalog_index(conn) -> dict:
+    # path -> (id, mtime, file_size, preview_thumb, sha256, fingerprint, module_count, preview_full)
+    return {
+        r[0]: r[1:] for r in conn.execute(
+            "SELECT path, id, mtime, file_size, preview_thumb, sha256, fingerprint, module_count, preview_full FROM lora"
+        )
+    }
+
+def list_thumbs() -> set[str]:
+    try:
+        with os.scandir(THUMB_DIR) as it:
+            return {e.name for e in it}
+    except OSError:
+        return set()
+
+def read_entry(st: Path, stat, fp: str, sha: str | None, now: int):
+    # サイドカーとsafetensorsのメタデータから lora の1行を作る。戻り値: (row, tags, png)
+    stem = st.with_suffix("")
+    png = find_preview_png(stem)
+    info = Path(str(stem) + ".info")
+    meta = Path(str(stem) + ".metadata.json")
+    
+    info_obj = read_text_json(info) or {}
+    meta_obj = read_text_json(meta) or {}
+    header   = read_safetensors_header(st)
+    st_md    = header.get("__metadata__")
+    st_md    = st_md if isinstance(st_md, dict) else {}
+    net_rank, module_count, arch = network_facts(header)
+    
+    name = info_obj.get("name") or st.stem
+    trigger = (
+        info_obj.get("triggerWords")
+        or meta_obj.get("trainedWords")
+        or st_md.get("ss_trigger_words")
+        or st_md.get("trigger_words")
+        or ""
+    )
+    if isinstance(trigger, list):
+        trigger = ", ".join(map(str, trigger))
+    
+    civitai_id = str(info_obj.get("id") or info_obj.get("modelId") or "")
+    preview_full = str(png) if png else None
+    # サムネは別プールで作る。パスはキーで決まるので先に書いておく
+    preview_thumb = str(thumb_path(sha or fp)) if png else None
     
+    tags = []
+    for key in ["tags", "trainedTags", "categories"]:
+        v = info_obj.get(key) or meta_obj.get(key)
+        if isinstance(v, list):
+            tags += [str(x) for x in v]
+        elif isinstance(v, str):
+            tags += [x.strip() for x in v.split(",")]
+    kind = st.parent.name if st.parent != LORA_ROOT else "Unsorted"
+    row = (
+        name, str(st), sha,
+        arch or "SDXL",  # 推定できなければIllustrious前提
+        kind,    # kindは後で付ける（char/style/detail）
+        trigger,
+        None,    # notes
+        preview_full,
+        preview_thumb,
+        pack_json(json.dumps(info_obj, ensure_ascii=False)) if info_obj else None,
+        pack_json(json.dumps(meta_obj, ensure_ascii=False)) if meta_obj else None,
+        civitai_id,
+        stat.st_size,
+        int(stat.st_mtime),
+        now,
+        name,
+        fp,
+        0 if sha else 1,
+        net_rank,
+        module_count,
+    )
+    return row, tags, png
+
+def write_batch(conn, tag_ids: dict, batch) -> list[int]:
+    # batch: [(row, tags, moved_id), ...]。upsertはRETURNINGでidを受け取る
+    # moved_idがあれば先にその行のpathを付け替えて、id/title/プリセットを引き継ぐ
+    ids = []
+    with prof.phase("db_upsert"):
+        for row, _, moved_id in batch:
+            if moved_id is not None:
+                conn.execute("UPDATE lora SET path=? WHERE id=?", (row[1], moved_id))
+            ids.append(upsert_lora(conn, row))
+    tagged = [(lora_id, tags) for lora_id, (_, tags, _) in zip(ids, batch) if tags]
+    if tagged:
+        with prof.phase("db_tags"):
+            set_tags(conn, tag_ids, tagged)
+    with prof.phase("db_fts"):
+        refresh_fts(conn, ids)
+    with prof.phase("commit"):
+        conn.commit()
+    prof.count("rows_written", len(ids))
+    return ids
+
+def prune_missing(conn, ids) -> None:
+    # ファイルが消えた行を削除する（プリセットはON DELETE CASCADE）
+    ids = list(ids)
+    for i in range(0, len(ids), FTS_CHUNK):
+        chunk = ids[i:i+FTS_CHUNK]
+        qmarks = ",".join(["?"] * len(chunk))
+        conn.execute(f"DELETE FROM lora_tag WHERE lora_id IN ({qmarks})", chunk)
+        conn.execute(f"DELETE FROM lora WHERE id IN ({qmarks})", chunk)
+    refresh_fts(conn, ids)
+
+def gc_thumbs(conn) -> int:
+    # どの行からも参照されていないサムネ（と書きかけの.tmp）をまとめて消す
+    referenced = set()
+    for sql in (
+        "SELECT preview_thumb FROM lora WHERE preview_thumb IS NOT NULL",
+        "SELECT thumb FROM lora_body_preset WHERE thumb IS NOT NULL",
+        "SELECT thumb FROM lora_outfit_preset WHERE thumb IS NOT NULL",
+    ):
+        referenced.update(os.path.basename(r[0]) for r in conn.execute(sql))
+    
+    removed = 0
+    for name in list_thumbs() - referenced:
+        if name.endswith((".webp", ".tmp")):
+            try:
+                (THUMB_DIR / name).unlink()
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def verify_pending(conn, pool) -> int:
+    # sha_pending=1 の行のsha256を埋める。検証中に変わったファイルは次回に回す
+    # 中断されたら、終わった分だけ書いて残りは次回に回す
+    rows = conn.execute("SELECT id, path, file_size, mtime FROM lora WHERE sha_pending=1 ORDER BY id").fetchall()
+    stop = pool_stop(pool)
+    jobs = [(r, pool.submit(sha256_file, Path(r[1]), stop=stop)) for r in rows]
+    
+    verified = 0
+    done = []
+    for i, ((lora_id, path, size, mtime), fut) in enumerate(jobs, 1):
+        if stop_requested.is_set():
+            for _, f in jobs[i-1:]:
+                f.cancel()
+            if fut.cancelled():
+                break
+        try:
+            with prof.phase("verify_wait"):
+                sha = fut.result()
+            stat = Path(path).stat()
+        except OSError:
+            continue
+        if sha is None:
+            continue
+        prof.count("bytes_verified", size)
+        if stat.st_size == size and int(stat.st_mtime) == mtime:
+            done.append((sha, lora_id, size, mtime))
+        if len(done) >= BATCH:
+            conn.executemany(
+                "UPDATE lora SET sha256=?, sha_pending=0 WHERE id=? AND sha_pending=1 AND file_size=? AND mtime=?",
+                done
+            )
+            conn.commit()
+            verified += len(done)
+            done = []
+        print_progress(i, len(jobs), 0, phase="verify")
+    
+    if done:
+        conn.executemany(
+            "UPDATE lora SET sha256=?, sha_pending=0 WHERE id=? AND sha_pending=1 AND file_size=? AND mtime=?",
+            done
+        )
+        verified += len(done)
+    conn.commit()
+    if jobs:
+        print()
+    return verified
+
+def collect_thumbs(conn, thumb_jobs):
+    # サムネ生成の完了待ち。失敗した分はpreview_thumbを外して次回スキャンで再試行させる
+    # 中断時はまだ始まっていない分を取り消して、失敗と同じ扱いにする。
+    # そのディレクトリはスナップショットも外す（先にチェックポイントされていても次回statし直す）
+    # 戻り値: (作った枚数, 秒数, 失敗したディレクトリ)
+    made = 0
+    secs = 0.0
+    failed = []
+    failed_dirs = set()
+    if stop_requested.is_set():
+        for *_, fut in thumb_jobs:
+            fut.cancel()
+    counted = set()
+    for lora_id, path, target, fut in thumb_jobs:
+        out, took = (None, 0.0) if fut.cancelled() else fut.result()
+        if out is None:
+            failed.append((lora_id, str(target)))
+            failed_dirs.add(os.path.dirname(path))
+        # 同じキーの行はジョブを共有しているので、時間と枚数は1回だけ数える
+        if id(fut) in counted:
+            continue
+        counted.add(id(fut))
+        secs += took
+        if out is not None and took:
+            made += 1
+            prof.add("thumb", took)
+    prof.count("thumbs_made", made)
+    conn.executemany("UPDATE lora SET preview_thumb=NULL WHERE id=? AND preview_thumb=?", failed)
+    conn.executemany("DELETE FROM scan_dir WHERE path=?", [(d,) for d in failed_dirs])
+    conn.commit()
+    return made, secs, sorted(failed_dirs)
+
+def scan_files(conn, pool, thumb_pool, files, index: dict, gone=(), *,
+               unchanged_dirs=frozenset(), previews: set | None = None, dir_snap: dict | None = None,
+               fast: bool = FAST_FINGERPRINT,
+               thumb_profile: str = THUMB_PROFILE, force: bool = False, progress: bool = True) -> dict:
+    # files を index（load_catalog_index）と突き合わせて更新する。フルスキャンとwatchで共通。
+    # gone: ディスクから消えたpath。新しいファイルと sha256/fingerprint が一致すれば移動扱い
+    # previews: walk_tree で見つけた.pngのパス。あればプレビューの有無をファイルを開かずに照合する
+    # dir_snap: walk_tree のスナップショット。渡すとディレクトリ単位でチェックポイントする
+    # force: サイドカーが変わった等で、mtime/サイズが同じでも読み直す
+    # stop_requested が立ったら書けた所までコミットして抜ける（戻り値の interrupted/remaining）
     now = int(time.time())
     updated = 0
     skipped = 0
-    files = sorted(LORA_ROOT.rglob("*.safetensors"))
     total = len(files)
     
+    # ループ中はDBもサムネフォルダも見ずに、ここで読んだ状態だけで判定する
     fts_ids = {r[0] for r in conn.execute("SELECT rowid FROM lora_fts")}
+    tag_ids = load_tag_ids(conn)
+    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    thumbs = list_thumbs()
+    thumb_dir = str(THUMB_DIR)
+    
+    missing = {index[p][0]: index[p] for p in gone if p in index}
+    missing_by_sha = {v[4]: lora_id for lora_id, v in missing.items() if v[4]}
+    missing_by_fp = {v[5]: lora_id for lora_id, v in missing.items() if v[5]}
+    moved = 0
     
-    pending = 0
+    # 1周目: statとインデックス照合だけ行い、ハッシュが必要なファイルはプールに投げておく
+    work = []
+    fts_missing = []
+    stop = pool_stop(pool)
     for i, st in enumerate(files, 1):
-        changed = False
-        stat = st.stat()
-        existing = conn.execute("SELECT id, mtime, file_size, preview_thumb, sha256 FROM lora WHERE path=?", (str(st),)).fetchone()
-
-        thumb_ok = False
-        if existing and existing[3]:
-            try:
-                thumb_ok = Path(existing[3]).exists()
-            except Exception:
-                thumb_ok = False
+        if stop_requested.is_set():
+            # stat前のディレクトリがどこか分からないので、今回はチェックポイントしない
+            dir_snap = None
+            break
+        existing = index.get(str(st))
+        thumb_ok = bool(
+            existing
+            and existing[3]
+            and os.path.dirname(existing[3]) == thumb_dir
+            and os.path.basename(existing[3]) in thumbs
+        )
+        
+        # プレビューの状態: 今あるプレビュー（find_preview_pngと同じ優先順）が行と同じで、
+        # あるならサムネも揃っていること。一覧が無い時（watch）はサムネだけで見る
+        if previews is None:
+            preview_ok = thumb_ok
+        else:
+            stem = os.path.normcase(str(st)[:-len(".safetensors")])
+            want = next((p for p in (stem + ".preview.png", stem + ".png") if p in previews), None)
+            have = os.path.normcase(existing[7]) if existing and existing[7] else None
+            preview_ok = bool(existing) and have == want and (want is None or thumb_ok)
+        
+        # 変化のないディレクトリでも、サムネが消えた/作れなかった行とカタログに無い行は読み直す
+        # （判定はメモリ上だけなのでstatは要らない）
+        if st.parent in unchanged_dirs and preview_ok:
+            skipped += 1
+            if progress:
+                print_progress(i, total, skipped, phase="stat")
+            continue
+        
+        with prof.phase("stat"):
+            stat = st.stat()
         
         file_unchanged = (
             existing
@@ -223,96 +770,386 @@ def main():
             and existing[2] == stat.st_size
         )
         
-        if existing:
-            lora_id = existing[0]
-            
-            if lora_id not in fts_ids:
-                sync_fts(conn, lora_id)
-                fts_ids.add(lora_id)
-                changed = True
+        if existing and existing[0] not in fts_ids:
+            fts_missing.append(existing[0])
         
-        need_update = not (file_unchanged and thumb_ok)
+        # module_countがNULLの行はヘッダ情報を取る前のもの
+        need_update = force or not (file_unchanged and preview_ok and existing[6] is not None)
         
         if need_update:
-            changed = True
-            
-            stem = st.with_suffix("")
-            png = find_preview_png(stem)
-            info = Path(str(stem) + ".info")
-            meta = Path(str(stem) + ".metadata.json")
-            
-            info_obj = read_text_json(info) or {}
-            meta_obj = read_text_json(meta) or {}
-            st_md    = read_safetensors_metadata(st)
-            
-            existing_sha = existing[4] if existing else None
-            
             if file_unchanged:
-                sha = existing_sha
+                hash_job = (existing[5], existing[4], 0.0, 0)
             else:
-                sha = sha256_file(st)
-            
-            name = info_obj.get("name") or st.stem
-            trigger = (
-                info_obj.get("triggerWords")
-                or meta_obj.get("trainedWords")
-                or st_md.get("ss_trigger_words")
-                or st_md.get("trigger_words")
-                or ""
-            )
-            if isinstance(trigger, list):
-                trigger = ", ".join(map(str, trigger))
-            
-            civitai_id = str(info_obj.get("id") or info_obj.get("modelId") or "")
-            preview_full = str(png) if png and png.exists() else None
-            preview_thumb = str(ensure_thumb(png, sha)) if png and png.exists() else None
-            
-            tags = []
-            for key in ["tags", "trainedTags", "categories"]:
-                v = info_obj.get(key) or meta_obj.get(key)
-                if isinstance(v, list):
-                    tags += [str(x) for x in v]
-                elif isinstance(v, str):
-                    tags += [x.strip() for x in v.split(",")]
-            kind = st.parent.name if st.parent != LORA_ROOT else "Unsorted"
-            row = (
-                name, str(st), sha,
-                "SDXL",  # Illustrious前提
-                kind,    # kindは後で付ける（char/style/detail）
-                trigger,
-                None,    # notes
-                preview_full,
-                preview_thumb,
-                json.dumps(info_obj, ensure_ascii=False) if info_obj else None,
-                json.dumps(meta_obj, ensure_ascii=False) if meta_obj else None,
-                civitai_id,
-                stat.st_size,
-                int(stat.st_mtime),
-                now,
-                name
-            )
-            
-            lora_id = upsert_lora(conn, row)
-            if tags:
-                set_tags(conn, lora_id, tags)
-            
-            sync_fts(conn, lora_id)
-            updated += 1
+                hash_job = pool.submit(hash_file, st, not fast, stop)
+            work.append((st, stat, existing, hash_job))
         else:
             skipped += 1
-            
-        if changed:
-           pending = bump_commit(conn, pending)
         
-        print_progress(i, total, skipped, phase="scan")
+        if progress:
+            print_progress(i, total, skipped, phase="stat")
+    if progress:
+        print()
     
+    # 書き込みが残っているディレクトリはスナップショットを外しておき、全部書けたバッチで保存し直す。
+    # 途中で止まっても落ちても、次回statし直すのは書き終わっていないディレクトリだけになる
+    pending_dirs = defaultdict(int)
+    if dir_snap is not None:
+        for st, *_ in work:
+            pending_dirs[str(st.parent)] += 1
+        conn.executemany("DELETE FROM scan_dir WHERE path=?", [(d,) for d in pending_dirs])
+        checkpoint_dirs(conn, dir_snap, [d for d in dir_snap if d not in pending_dirs])
+    refresh_fts(conn, fts_missing)
     conn.commit()
-    print()
-    print(f"done. updated={updated}, skipped={skipped}, db={DB_PATH}")
+    
+    # 2周目: メタデータ読み込みとDB書き込み（書き込みはこのスレッドだけ・ファイル順）
+    thumb_jobs = []
+    thumb_futs = {}  # キー -> Future。複製されたLoRA（同じsha）のサムネは1回だけ作る
+    batch = []
+    batch_thumbs = []
+    
+    def flush():
+        nonlocal updated, batch, batch_thumbs
+        done_dirs = []
+        for row, _, _ in batch:
+            d = os.path.dirname(row[1])
+            pending_dirs[d] -= 1
+            if pending_dirs[d] == 0:
+                done_dirs.append(d)
+        if dir_snap is not None:
+            checkpoint_dirs(conn, dir_snap, done_dirs)
+        ids = write_batch(conn, tag_ids, batch)
+        thumb_jobs.extend((lora_id, *job) for lora_id, job in zip(ids, batch_thumbs) if job)
+        updated += len(batch)
+        batch = []
+        batch_thumbs = []
+    
+    interrupted = False
+    for i, (st, stat, existing, hash_job) in enumerate(work, 1):
+        if stop_requested.is_set() and not interrupted:
+            # まだ始まっていないハッシュは捨てる。計算済み/計算中の分は待って書く
+            interrupted = True
+            for *_, job in work[i-1:]:
+                if isinstance(job, Future):
+                    job.cancel()
+        if interrupted and not (isinstance(hash_job, Future) and not hash_job.cancelled()):
+            continue
+        
+        # ハッシュは後ろのファイルの分も並行して進んでいる
+        with prof.phase("hash_wait"):
+            fp, sha, hash_secs, nbytes = hash_job.result() if isinstance(hash_job, Future) else hash_job
+        if nbytes:
+            prof.add("hash", hash_secs)
+            prof.count("bytes_hashed", nbytes)
+        # mtime/サイズが同じファイルはハッシュせず、行のsha/fingerprintをそのまま使っている（上の1周目）。
+        # ここでshaがNoneなのは中身が変わった可能性のあるファイル。fingerprintが同じでも
+        # 抜き取りの外が書き換わっているかもしれないので古いshaは引き継がず、sha_pendingで検証に回す
+        # （fingerprintは移動の判定にだけ使う）
+        
+        moved_id = None
+        if existing is None and missing:
+            moved_id = missing_by_sha.get(sha) if sha else None
+            if moved_id is None:
+                moved_id = missing_by_fp.get(fp)
+            if moved_id is not None and missing.pop(moved_id, None):
+                moved += 1
+            else:
+                moved_id = None
+        
+        with prof.phase("read_meta"):
+            row, tags, png = read_entry(st, stat, fp, sha, now)
+        thumb_job = None
+        if png:
+            key = sha or fp
+            if key not in thumb_futs:
+                thumb_futs[key] = thumb_pool.submit(ensure_thumb, png, key, thumb_profile)
+            thumb_job = (row[1], Path(row[8]), thumb_futs[key])
+        batch.append((row, tags, moved_id))
+        batch_thumbs.append(thumb_job)
+        
+        if len(batch) >= BATCH:
+            flush()
+        
+        if progress:
+            print_progress(i, len(work), skipped, phase="scan")
+    if batch:
+        flush()
+    
+    # 中断時は残りのファイルに移動先があるかもしれないので消さない
+    if interrupted:
+        missing = {}
+    if missing:
+        with prof.phase("prune"):
+            prune_missing(conn, missing)
+    conn.commit()
+    if progress:
+        print()
+    
+    with prof.phase("thumb_wait"):
+        made, thumb_secs, thumb_failed_dirs = collect_thumbs(conn, thumb_jobs)
+    return {
+        "updated": updated,
+        "skipped": skipped,
+        "moved": moved,
+        "pruned": len(missing),
+        "fts_repaired": len(fts_missing),
+        "thumbs": made,
+        "thumb_secs": thumb_secs,
+        "thumb_failed_dirs": thumb_failed_dirs,
+        "interrupted": interrupted or stop_requested.is_set(),
+        "remaining": total - skipped - updated,
+    }
+
+def main(hash_workers: int = HASH_WORKERS, hash_executor: str = HASH_EXECUTOR,
+         fast: bool = FAST_FINGERPRINT, verify: bool = True,
+         thumb_workers: int = THUMB_WORKERS, thumb_profile: str = THUMB_PROFILE,
+         full: bool = False, prune: bool = True,
+         profile: bool = False, report: str | None = None) -> dict:
+    # profile/report が無ければ計測は NullProfiler のまま（コストなし）
+    # Ctrl-C/SIGTERMではバッチ単位でコミットして抜け、次回は書き終わっていない分だけ続きをやる
+    with stop_on_signal():
+        return scan_main(hash_workers, hash_executor, fast, verify, thumb_workers, thumb_profile,
+                         full, prune, profile, report)
+
+def scan_main(hash_workers, hash_executor, fast, verify, thumb_workers, thumb_profile,
+              full, prune, profile, report) -> dict:
+    global prof
+    prof = ScanProfiler() if (profile or report) else NullProfiler()
+    
+    conn = sqlite3.connect(DB_PATH)
+    init_db(conn)
+    apply_migrations(conn)
+    # アプリ側で途中まで進んだバックフィルもスキャン前に終わらせる
+    with prof.phase("backfill"):
+        run_backfills(conn, stop=stop_requested)
+    
+    with prof.phase("walk"):
+        files, unchanged_dirs, dir_snap, failed_dirs, previews = walk_tree(conn, full)
+    with prof.phase("load_index"):
+        index = load_catalog_index(conn)
+    
+    # 読めないディレクトリがある時（ドライブ未接続など）は全部消してしまわないよう何もしない
+    if failed_dirs:
+        print(f"[prune] skipped: cannot read {', '.join(map(str, failed_dirs))}")
+        prune = False
+    gone = index.keys() - {str(f) for f in files} if prune else ()
+    
+    with make_executor(hash_executor, hash_workers) as pool, \
+         ThreadPoolExecutor(max_workers=thumb_workers) as thumb_pool:
+        stats = scan_files(
+            conn, pool, thumb_pool, files, index, gone,
+            unchanged_dirs=unchanged_dirs, previews=previews, dir_snap=dir_snap,
+            fast=fast, thumb_profile=thumb_profile,
+        )
+        if stats["interrupted"]:
+            # 書けた分とディレクトリのチェックポイントはコミット済み。後片付けと検証は次回に回す
+            conn.close()
+            print(f"interrupted. updated={stats['updated']}, remaining={stats['remaining']} "
+                  f"(run again to resume), db={DB_PATH}")
+            prof = NullProfiler()
+            return stats
+        
+        # 全ファイルを書き終えたら消えたディレクトリの分も含めて入れ替える。
+        # サムネを作れなかったディレクトリは入れずに、次回もう一度見る
+        save_dir_snapshot(conn, {d: v for d, v in dir_snap.items() if d not in stats["thumb_failed_dirs"]})
+        conn.commit()
+        with prof.phase("gc_thumbs"):
+            removed_thumbs = gc_thumbs(conn) if prune else 0
+        if stats["updated"] + stats["fts_repaired"] + stats["pruned"] >= FTS_OPTIMIZE_MIN:
+            with prof.phase("fts_optimize"):
+                optimize_fts(conn)
+                conn.commit()
+        made = stats["thumbs"]
+        print(f"done. updated={stats['updated']}, skipped={stats['skipped']}, moved={stats['moved']}, "
+              f"pruned={stats['pruned']}, db={DB_PATH}")
+        print(f"thumbs={made} ({stats['thumb_secs']:.2f}s worker time, "
+              f"{(stats['thumb_secs'] / made * 1000) if made else 0:.1f}ms/thumb, profile={thumb_profile}), "
+              f"removed_thumbs={removed_thumbs}")
+        
+        # ここまででカタログには載っている。全体ハッシュは後追いで検証する
+        if verify:
+            with prof.phase("verify"):
+                verified = verify_pending(conn, pool)
+            print(f"verified={verified}")
+    conn.close()
+    
+    if isinstance(prof, ScanProfiler):
+        prof.print_summary()
+        if report:
+            rep = prof.report()
+            rep["stats"] = stats
+            rep["config"] = {
+                "root": str(LORA_ROOT), "hash_workers": hash_workers, "hash_executor": hash_executor,
+                "fast": fast, "thumb_workers": thumb_workers, "thumb_profile": thumb_profile, "full": full,
+            }
+            Path(report).write_text(json.dumps(rep, indent=2), encoding="utf-8")
+            print(f"report -> {report}")
+        prof = NullProfiler()
+    return stats
+
+def entry_for(path: str) -> str | None:
+    # 本体/サイドカーのパス -> 対応する.safetensorsのパス。関係ないファイルはNone
+    if path.startswith(str(THUMB_DIR)) or os.path.basename(path).startswith(DB_PATH.name):
+        return None
+    for suffix in WATCH_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)] + ".safetensors"
+    return None
+
+def poll_state() -> dict:
+    # ポーリング用: 関係するファイルの path -> (mtime_ns, size)
+    state = {}
+    stack = [LORA_ROOT]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir():
+                        if e.path != str(THUMB_DIR):
+                            stack.append(Path(e.path))
+                    elif entry_for(e.path):
+                        st = e.stat()
+                        state[e.path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            continue
+    return state
+
+def process_changes(conn, pool, thumb_pool, keys, fast: bool, thumb_profile: str) -> dict:
+    # keys: ("f", .safetensorsのパス) / ("d", ディレクトリ)。該当するエントリだけ処理する
+    index = load_catalog_index(conn)
+    paths = set()
+    for kind, p in keys:
+        if kind == "d":
+            prefix = p.rstrip(os.sep) + os.sep
+            paths.update(k for k in index if k.startswith(prefix))
+            if os.path.isdir(p) and p != str(THUMB_DIR):
+                paths.update(str(f) for f in Path(p).rglob("*.safetensors"))
+        else:
+            paths.add(p)
+    
+    files = sorted(Path(p) for p in paths if os.path.isfile(p))
+    gone = [p for p in paths if p in index and not os.path.exists(p)]
+    stats = scan_files(
+        conn, pool, thumb_pool, files, index, gone,
+        fast=fast, thumb_profile=thumb_profile, force=True, progress=False,
+    )
+    if stats["pruned"]:
+        gc_thumbs(conn)
+    return stats
+
+def watch(hash_workers: int = HASH_WORKERS, hash_executor: str = HASH_EXECUTOR,
+          fast: bool = FAST_FINGERPRINT, verify: bool = True,
+          thumb_workers: int = THUMB_WORKERS, thumb_profile: str = THUMB_PROFILE):
+    # 常駐してファイルの変化に追従する。まとめて届くイベント（本体+.info+.preview.png）は
+    # WATCH_DEBOUNCE_SEC 静かになるまで待ってから1回で処理する
+    lock = threading.Lock()
+    changed = {}  # key -> 最後にイベントが来た時刻
+    
+    def notify(key):
+        with lock:
+            changed[key] = time.monotonic()
+    
+    observer = None
+    if Observer is not None:
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # opened/closed_no_write は自分の読み込みでも発生するので無視する
+                if event.event_type not in WATCH_EVENTS:
+                    return
+                for p in (event.src_path, getattr(event, "dest_path", "")):
+                    if not p:
+                        continue
+                    p = os.fsdecode(p)
+                    if event.is_directory:
+                        if event.event_type != "modified":
+                            notify(("d", p))
+                    else:
+                        target = entry_for(p)
+                        if target:
+                            notify(("f", target))
+        
+        observer = Observer()
+        observer.schedule(Handler(), str(LORA_ROOT), recursive=True)
+        observer.start()
+        print(f"[watch] {LORA_ROOT} (events)")
+    else:
+        print(f"[watch] {LORA_ROOT} (watchdog not installed, polling every {WATCH_POLL_SEC}s)")
+    
+    state = poll_state() if observer is None else None
+    next_poll = time.monotonic() + WATCH_POLL_SEC
+    
+    conn = sqlite3.connect(DB_PATH)
+    init_db(conn)
+    apply_migrations(conn)
+    run_backfills(conn)
+    try:
+        with make_executor(hash_executor, hash_workers) as pool, \
+             ThreadPoolExecutor(max_workers=thumb_workers) as thumb_pool:
+            while True:
+                time.sleep(0.5)
+                if observer is None and time.monotonic() >= next_poll:
+                    new_state = poll_state()
+                    diff = state.keys() ^ new_state.keys()
+                    diff |= {p for p in state.keys() & new_state.keys() if state[p] != new_state[p]}
+                    for p in diff:
+                        notify(("f", entry_for(p)))
+                    state = new_state
+                    next_poll = time.monotonic() + WATCH_POLL_SEC
+                
+                now = time.monotonic()
+                with lock:
+                    ready = [k for k, t in changed.items() if now - t >= WATCH_DEBOUNCE_SEC]
+                    for k in ready:
+                        del changed[k]
+                if not ready:
+                    continue
+                
+                stats = process_changes(conn, pool, thumb_pool, ready, fast, thumb_profile)
+                print(f"[watch] {time.strftime('%H:%M:%S')} updated={stats['updated']}, "
+                      f"moved={stats['moved']}, pruned={stats['pruned']}, thumbs={stats['thumbs']}")
+                if verify and fast:
+                    verify_pending(conn, pool)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        conn.close()
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--hash-workers", type=int, default=HASH_WORKERS)
+    ap.add_argument("--hash-executor", choices=["thread", "process"], default=HASH_EXECUTOR)
+    ap.add_argument("--fast", action="store_true", default=FAST_FINGERPRINT,
+                    help="fingerprintだけで登録し、sha256は後から検証する")
+    ap.add_argument("--thumb-workers", type=int, default=THUMB_WORKERS)
+    ap.add_argument("--thumb-profile", choices=list(THUMB_PROFILES), default=THUMB_PROFILE)
+    ap.add_argument("--full", action="store_true",
+                    help="ディレクトリのスナップショットを使わず全ファイルをstatする")
+    ap.add_argument("--no-prune", dest="prune", action="store_false",
+                    help="消えたファイルの行と不要なサムネを削除しない")
+    ap.add_argument("--watch", action="store_true",
+                    help="スキャン後も常駐してファイルの変化を反映し続ける")
+    ap.add_argument("--profile", action="store_true", help="フェーズ別の時間とカウンタを表示する")
+    ap.add_argument("--report", metavar="JSON", help="計測結果をJSONで書き出す（--profileを含む）")
+    ap.add_argument("--no-verify", dest="verify", action="store_false",
+                    help="sha_pendingの検証パスを実行しない")
+    args = ap.parse_args()
+    
     a = time.time()
-    main()
+    stats = main(hash_workers=args.hash_workers, hash_executor=args.hash_executor,
+         fast=args.fast, verify=args.verify,
+         thumb_workers=args.thumb_workers, thumb_profile=args.thumb_profile,
+         full=args.full, prune=args.prune,
+         profile=args.profile, report=args.report)
     b = time.time()
     print(f"time={b-a:.4f}s")
+    if stats["interrupted"]:
+        sys.exit(130)
+    
+    if args.watch:
+        watch(hash_workers=args.hash_workers, hash_executor=args.hash_executor,
+              fast=args.fast, verify=args.verify,
+              thumb_workers=args.thumb_workers, thumb_profile=args.thumb_profile)
     
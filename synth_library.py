@@ -0,0 +1,127 @@
+import os, json, random, struct, argparse
+from pathlib import Path
+from PIL import Image
+
+# ベンチ用の合成LoRAライブラリを作る。
+# 小さいけど正しい形の.safetensorsヘッダ、Civitai風の.info/.metadata.json、プレビューPNGを
+# kindフォルダに振り分けて置く（実ファイルの重さは --payload-kb で調整）
+
+KINDS = ["char", "style", "detail", "concept", "pose", "clothing"]
+
+TAG_VOCAB = [
+    "character", "anime", "girl", "boy", "style", "concept", "clothing", "background",
+    "illustrious", "sdxl", "pony", "realistic", "3d", "chibi", "portrait", "fantasy",
+    "sci-fi", "school uniform", "maid", "armor", "kimono", "swimsuit", "hairstyle",
+    "detail", "lighting", "watercolor", "sketch", "lineart", "pixel art", "game character",
+    "vtuber", "original character", "cyberpunk", "horror", "cute", "landscape", "food",
+    "animal ears", "weapon", "vehicle", "building", "flower", "monster", "mecha",
+]
+
+# 短い日本語名・略称（2文字以下の検索用）を混ぜる
+NAME_WORDS = [
+    "Miku", "Reimu", "Marisa", "Sakura", "Rin", "Asuna", "Saber", "Rem", "Emilia", "Nezuko",
+    "初音ミク", "霊夢", "魔理沙", "桜", "凛", "蘭", "響", "雪", "Ai", "KK", "XL", "v2",
+    "Cyber", "Retro", "Watercolor", "Ink", "Neon", "Detail", "Lighting", "Outfit", "Armor",
+]
+
+LAYERS_SDXL = [
+    "lora_unet_input_blocks_{b}_1_transformer_blocks_{t}_attn1_to_q",
+    "lora_unet_input_blocks_{b}_1_transformer_blocks_{t}_attn2_to_k",
+    "lora_unet_output_blocks_{b}_1_transformer_blocks_{t}_ff_net_2",
+    "lora_te1_text_model_encoder_layers_{t}_mlp_fc1",
+    "lora_te2_text_model_encoder_layers_{t}_self_attn_q_proj",
+]
+
+F16_BYTES = 2
+
+def safetensors_bytes(rng: random.Random, modules: int, rank: int, payload: int) -> bytes:
+    # テンソルのdata_offsetsは dtypeのバイト数 × 要素数 で隙間なく並べ、ヘッダの後ろのデータ部をちょうど覆う
+    # （safetensorsのローダーで読める形）。rankはshapeに正しく入れ、入力次元の方を
+    # payload に収まるよう縮める（1未満にはしないので、モジュールが多いと payload を超える）
+    header = {
+        "__metadata__": {
+            "ss_network_dim": str(rank),
+            "ss_network_alpha": str(rank // 2 or 1),
+            "ss_base_model_version": "sdxl_base_v1-0",
+            "ss_network_module": "networks.lora",
+        }
+    }
+    # 1モジュール = down[rank, dim] + up[dim, rank]
+    dim = max(1, payload // (modules * 2 * rank * F16_BYTES))
+    offset = 0
+    for m in range(modules):
+        base = LAYERS_SDXL[m % len(LAYERS_SDXL)].format(b=m % 9, t=m % 10)
+        for suffix, shape in ((".lora_down.weight", [rank, dim]), (".lora_up.weight", [dim, rank])):
+            size = shape[0] * shape[1] * F16_BYTES
+            header[f"{base}_{m}{suffix}"] = {"dtype": "F16", "shape": shape, "data_offsets": [offset, offset + size]}
+            offset += size
+    hb = json.dumps(header).encode("utf-8")
+    hb += b" " * (-len(hb) % 8)
+    return struct.pack("<Q", len(hb)) + hb + rng.randbytes(offset)
+
+def info_obj(rng: random.Random, i: int, name: str, tags: list[str]) -> dict:
+    # Civitaiの.infoに近い形。descriptionやimagesで数十KBになる
+    return {
+        "id": 100000 + i,
+        "modelId": 50000 + i,
+        "name": name,
+        "triggerWords": [f"{name.lower().replace(' ', '_')}", rng.choice(TAG_VOCAB)],
+        "tags": tags,
+        "description": " ".join(rng.choice(TAG_VOCAB) for _ in range(rng.randint(200, 2000))),
+        "images": [
+            {"url": f"https://example.invalid/{i}/{k}.png", "width": 832, "height": 1216,
+             "meta": {"prompt": ", ".join(rng.sample(TAG_VOCAB, 12)), "seed": rng.randint(0, 2**31)}}
+            for k in range(rng.randint(2, 12))
+        ],
+    }
+
+def write_entry(root: Path, rng: random.Random, i: int, args) -> Path:
+    kind = rng.choice(KINDS + [""] * max(1, len(KINDS) // 5))
+    d = root / kind if kind else root
+    d.mkdir(parents=True, exist_ok=True)
+    name = f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_WORDS)} {i}"
+    stem = d / f"lora_{i:06d}"
+    
+    modules = rng.randint(args.modules_min, args.modules_max)
+    rank = rng.choice([4, 8, 16, 32, 64])
+    path = stem.with_suffix(".safetensors")
+    path.write_bytes(safetensors_bytes(rng, modules, rank, args.payload_kb * 1024))
+    
+    tags = rng.sample(TAG_VOCAB, rng.randint(args.tags_min, args.tags_max))
+    Path(str(stem) + ".info").write_text(json.dumps(info_obj(rng, i, name, tags), ensure_ascii=False), encoding="utf-8")
+    if rng.random() < 0.5:
+        meta = {"trainedWords": [name.split()[0]], "categories": rng.sample(TAG_VOCAB, 3)}
+        Path(str(stem) + ".metadata.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    if rng.random() < args.preview_ratio:
+        w = args.preview_size
+        h = w * 3 // 2
+        img = Image.new("RGB", (w, h), tuple(rng.randrange(256) for _ in range(3)))
+        # 単色だと圧縮が効きすぎるので少しノイズを入れる
+        img.paste(Image.effect_noise((w // 4, h // 4), 64).convert("RGB").resize((w, h)))
+        img.save(str(stem) + ".preview.png", compress_level=1)
+    return path
+
+def generate(root: Path, count: int, args) -> list[Path]:
+    rng = random.Random(args.seed)
+    root.mkdir(parents=True, exist_ok=True)
+    return [write_entry(root, rng, i, args) for i in range(count)]
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="合成LoRAライブラリを作る")
+    ap.add_argument("root", type=Path)
+    ap.add_argument("--count", type=int, default=1000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--tags-min", type=int, default=5)
+    ap.add_argument("--tags-max", type=int, default=30)
+    ap.add_argument("--modules-min", type=int, default=64)
+    ap.add_argument("--modules-max", type=int, default=720)
+    ap.add_argument("--payload-kb", type=int, default=256, help="テンソルデータ部のおおよその大きさ(KB)")
+    ap.add_argument("--preview-ratio", type=float, default=0.8)
+    ap.add_argument("--preview-size", type=int, default=768, help="プレビューの幅(px)。高さは1.5倍")
+    return ap
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    files = generate(args.root, args.count, args)
+    total = sum(os.path.getsize(f) for f in files)
+    print(f"generated {len(files)} LoRAs ({total / 1e6:.1f} MB of .safetensors) under {args.root}")
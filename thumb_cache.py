@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# グリッド用サムネイルのバイト列をプロセス内に持つ。
+# サムネイルは sha(か指紋)のファイル名で作られるので、キーが同じなら中身も同じ＝無効化は要らない。
+# Streamlit は再実行でモジュールを読み直さないので、キャッシュはプロセスが生きている間残る。
+
+THUMB_CACHE_BYTES = 64 * 1024 * 1024  # 320pxのwebpなら数千枚
+MISSING_TTL_SEC   = 30.0              # 無かったサムネイルは少し経ったら見直す（スキャン後に出来る）
+PREFETCH_WORKERS  = 2
+
+class ThumbCache:
+    def __init__(self, max_bytes: int = THUMB_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()   # key -> bytes（LRU順）
+        self._missing = {}           # key -> 見つからなかった時刻
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="thumb-prefetch")
+
+    @staticmethod
+    def key(path) -> str:
+        return Path(path).stem
+
+    def _lookup(self, key: str):
+        # (見つかった?, bytes or None)。ロックを持った状態で呼ぶ
+        data = self._data.get(key)
+        if data is not None:
+            self._data.move_to_end(key)
+            return True, data
+        t = self._missing.get(key)
+        if t is not None and time.monotonic() - t < MISSING_TTL_SEC:
+            return True, None
+        return False, None
+
+    def _store(self, key: str, data: bytes | None):
+        with self._lock:
+            if data is None:
+                self._missing[key] = time.monotonic()
+                return
+            self._missing.pop(key, None)
+            if key in self._data or len(data) > self.max_bytes:
+                return
+            self._data[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self._size -= len(old)
+
+    def _load(self, path, key: str):
+        try:
+            data = Path(path).read_bytes()
+        except OSError:
+            data = None
+        self._store(key, data)
+        return data
+
+    def get(self, path) -> bytes | None:
+        # 無ければNone。exists() の代わりにもなる
+        if not path:
+            return None
+        key = self.key(path)
+        with self._lock:
+            found, data = self._lookup(key)
+        if found:
+            return data
+        return self._load(path, key)
+
+    def prefetch(self, paths_fn):
+        # paths_fn（隣のページのサムネイルパスを返す関数）ごとバックグラウンドで実行する
+        self._pool.submit(self._prefetch, paths_fn)
+
+    def _prefetch(self, paths_fn):
+        for path in paths_fn():
+            if not path:
+                continue
+            key = self.key(path)
+            with self._lock:
+                found, _ = self._lookup(key)
+                if found or key in self._inflight:
+                    continue
+                self._inflight.add(key)
+            try:
+                self._load(path, key)
+            finally:
+                with self._lock:
+                    self._inflight.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._size, "missing": len(self._missing)}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def cache() -> ThumbCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ThumbCache()
+    return _cache
+
+def thumb_bytes(path) -> bytes | None:
+    return cache().get(path)
+
+def prefetch(paths_fn):
+    cache().prefetch(paths_fn)